@@ -5,21 +5,35 @@
 # ======================
 from flask import (Flask, render_template, request,
                    redirect, jsonify, url_for,
-                   flash, make_response)
-from sqlalchemy import create_engine, asc, desc
-from sqlalchemy.orm import sessionmaker, scoped_session
+                   flash, make_response, Response,
+                   stream_with_context, g, send_file)
+from sqlalchemy import asc, desc, or_, and_, text, event, inspect, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import (sessionmaker, scoped_session, contains_eager,
+                            joinedload)
 from database_setup import *
+from cache import TTLCache, ResponseCache, MemoryBackend, FileBackend
+from profiling import Metrics, Profiler, metrics_response
+from jobs import JobQueue
+import templating
+from compression import Compressor
+from assets import StaticAssets
+from thumbnails import Thumbnailer, ThumbnailError
+from replicas import Router, RoutingSession
+from sessions import ServerSessionInterface, MemoryStore, SQLiteStore
 from flask import session as login_session
-from oauth2client.client import flow_from_clientsecrets
-from oauth2client.client import FlowExchangeError
 import os
 import random
 import string
 import datetime
 import json
-import httplib2
-import requests
+import base64
+import hashlib
+import collections
+import oauth
+import fastjson
 from functools import wraps
+from markupsafe import Markup, escape
 
 
 # ======================
@@ -32,23 +46,291 @@ app = Flask(__name__)
 # Load Client Secrets
 # ======================
 
-CLIENT_ID = json.loads(
-    open('client_secrets.json', 'r').read())['web']['client_id']
+# Read from CLIENT_SECRETS on first use, see oauth.client_id()
 APPLICATION_NAME = "Item-Catalog"
 
 # ======================
 # Database Connection
 # ======================
 
-engine = create_engine('sqlite:///item_database.db')
-Base.metadata.bind = engine
-session = scoped_session(sessionmaker(bind=engine))
+# Bound to an engine by create_app
+engine = None
+session = scoped_session(sessionmaker(class_=RoutingSession))
+SEARCH_ENABLED = False
+
+# Reads go to the READ_REPLICAS engines when there are any, writes to the
+# primary. Requests other than GET and HEAD use the primary throughout, and
+# so does a client for REPLICA_STICKY_SECONDS after it commits, so it
+# reads its own writes. That is tracked with a short-lived cookie rather
+# than the login session, which would add Vary: Cookie to every response.
+router = None
+REPLICA_STICKY_SECONDS = 10
+PRIMARY_COOKIE = 'read_primary'
+
+
+@app.before_request
+def requireCreateApp():
+    if engine is None:
+        raise RuntimeError('the app is not connected to its database, '
+                           'serve create_app() rather than app')
+
+
+@app.before_request
+def routeSession():
+    if request.method not in ('GET', 'HEAD') or \
+            PRIMARY_COOKIE in request.cookies:
+        session().use_primary = True
+
+
+@app.after_request
+def stickToPrimary(response):
+    if session.registry.has() and session().wrote:
+        response.set_cookie(PRIMARY_COOKIE, '1', httponly=True,
+                            max_age=int(REPLICA_STICKY_SECONDS))
+    return response
 
 
 @app.teardown_request
 def remove_session(ex=None):
     session.remove()
 
+
+# ======================
+# Category Cache
+# ======================
+
+# Sorted category list rendered in the sidebar of every page. Routes that
+# write categories invalidate it, the TTL bounds staleness across workers.
+CATEGORY_CACHE_TTL = 30
+category_cache = TTLCache(ttl=CATEGORY_CACHE_TTL, maxsize=1)
+
+
+def getCategories():
+    '''Returns (id, name, user_id, item_count) rows for all categories
+    sorted by name'''
+    return category_cache.get('categories', lambda: session.query(
+        Category.id, Category.name, Category.user_id,
+        Category.item_count).order_by(asc(Category.name)).all())
+
+
+# ======================
+# Response Cache
+# ======================
+
+# JSON responses are cached per catalog version, for at most
+# RESPONSE_CACHE_TTL seconds. The version is kept in RESPONSE_CACHE_VERSION,
+# a file every worker process shares, so a write in one worker invalidates
+# the caches of all of them. Set RESPONSE_CACHE_DIR to share the cached
+# responses as well, create_app switches to a FileBackend then.
+response_cache = ResponseCache(MemoryBackend())
+
+
+# ======================
+# Template Caches
+# ======================
+
+# Shared includes wrapped in {% cache %} (the header and the category list)
+# are rendered once per catalog version and login state. Compiled templates
+# are kept in TEMPLATE_CACHE_DIR so new workers skip compilation, and
+# PRECOMPILE_TEMPLATES=1 compiles them all at startup.
+fragment_cache = TTLCache(ttl=CATEGORY_CACHE_TTL, maxsize=64)
+
+
+@app.before_request
+def readCatalogVersion():
+    # Before any query, so a fragment is never cached under a version
+    # newer than the data it was rendered from
+    g.catalog_version = response_cache.backend.get_version()
+
+
+def fragmentCacheKey():
+    '''Catalog version and login state, looked up once per request'''
+    if 'fragment_cache_key' not in g:
+        g.fragment_cache_key = (g.catalog_version,
+                                'username' in login_session)
+    return g.fragment_cache_key
+
+
+# ======================
+# Background Jobs
+# ======================
+
+# Side effects of writes run after the commit on a background thread pool.
+# Jobs are kept in a SQLite outbox (JOB_OUTBOX) until they succeed. The
+# queue is started by create_app.
+jobs = None
+
+
+def catalogChangedJob(action, name):
+    response_cache.backend.prune()
+    app.logger.info('catalog changed: %s %s', action, name)
+
+
+def catalogChanged(action, name):
+    '''Called after every catalog write. Cached data is invalidated right
+    away so the writer sees the change, the rest runs in the background.
+    Item writes change the category item counts, so they clear the sidebar
+    too'''
+    response_cache.bump_version()
+    category_cache.invalidate()
+    fragment_cache.invalidate()
+    jobs.enqueue('catalog_changed', {'action': action, 'name': name})
+
+
+@app.route('/cache/stats')
+def cacheStats():
+    return jsonify(categories=category_cache.stats,
+                   fragments=fragment_cache.stats,
+                   users=user_cache.stats,
+                   responses=response_cache.backend.stats)
+
+
+# ======================
+# Sessions
+# ======================
+
+# Session data is kept server side and the cookie only carries its id.
+# SESSION_STORE is sqlite (SESSION_DB, shared by every worker), memory (a
+# single process only) or cookie for Flask's signed cookie sessions.
+# Sessions expire SESSION_TTL seconds after the last request. The store is
+# opened by create_app.
+SESSION_STORE = 'cookie'
+
+
+def regenerateSession():
+    '''Moves a server-side session to a new id on login and logout, so an
+    id known beforehand can't be used to take it over. Signed cookie
+    sessions have no id to move'''
+    regenerate = getattr(login_session, 'regenerate', None)
+    if regenerate is not None:
+        regenerate()
+
+
+# ======================
+# Compression and Static Files
+# ======================
+
+# Responses above COMPRESS_MIN_SIZE bytes are gzip or brotli compressed
+# for clients that accept it, streamed exports chunk by chunk. Files under
+# static/ are served fingerprinted and precompressed once `python
+# assets.py` has built them.
+compressor = Compressor()
+static_assets = StaticAssets()
+
+
+# ======================
+# Metrics and Profiling
+# ======================
+
+# /metrics is always served. Per-request timing (Server-Timing headers and
+# the request/SQL/template metrics) is enabled with PROFILE_REQUESTS=1, and
+# PROFILE_SAMPLE_DIR additionally dumps sampled stacks of requests slower
+# than PROFILE_SLOW_MS in flamegraph collapsed format.
+metrics = Metrics()
+
+
+def cacheMetrics():
+    caches = [('categories', category_cache.stats),
+              ('fragments', fragment_cache.stats),
+              ('users', user_cache.stats),
+              ('responses', response_cache.backend.stats),
+              ('compressed', compressor.cache.stats)]
+    return [
+        ('catalog_cache_hits_total', 'counter', 'Cache hits',
+         [({'cache': name}, stats['hits']) for name, stats in caches]),
+        ('catalog_cache_misses_total', 'counter', 'Cache misses',
+         [({'cache': name}, stats['misses']) for name, stats in caches]),
+    ]
+
+
+def jobMetrics():
+    stats = jobs.stats
+    return [
+        ('catalog_jobs_queued', 'gauge', 'Jobs in the outbox by status',
+         [({'status': status}, stats[status])
+          for status in ('pending', 'running', 'failed')]),
+        ('catalog_jobs_processed_total', 'counter', 'Jobs completed',
+         [({}, stats['processed'])]),
+        ('catalog_jobs_retries_total', 'counter', 'Failed job attempts '
+         'that were retried', [({}, stats['retries'])]),
+        ('catalog_jobs_latency_seconds_total', 'counter', 'Time from '
+         'enqueue to completion of completed jobs',
+         [({}, stats['latency_seconds'])]),
+    ]
+
+
+def sessionMetrics():
+    if SESSION_STORE == 'cookie':
+        return []
+    stats = app.session_interface.stats
+    return [
+        ('catalog_sessions_stored', 'gauge', 'Sessions in the store',
+         [({'store': SESSION_STORE}, stats['size'])]),
+        ('catalog_session_lookups_total', 'counter', 'Session store lookups',
+         [({'store': SESSION_STORE}, stats['lookups'])]),
+        ('catalog_session_lookup_misses_total', 'counter', 'Lookups of '
+         'unknown or expired sessions',
+         [({'store': SESSION_STORE}, stats['misses'])]),
+        ('catalog_session_lookup_seconds_total', 'counter', 'Time spent '
+         'loading sessions', [({'store': SESSION_STORE},
+                               stats['lookup_seconds'])]),
+        ('catalog_sessions_expired_total', 'counter', 'Expired sessions '
+         'removed by the sweeper',
+         [({'store': SESSION_STORE}, stats['expired'])]),
+    ]
+
+
+def thumbnailMetrics():
+    stats = thumbnailer.stats
+    return [
+        ('catalog_thumbnail_cache_hits_total', 'counter', 'Thumbnails '
+         'served from the disk cache', [({}, stats['hits'])]),
+        ('catalog_thumbnail_cache_misses_total', 'counter', 'Thumbnails '
+         'not in the disk cache', [({}, stats['misses'])]),
+        ('catalog_thumbnail_cache_bytes', 'gauge', 'Size of the thumbnail '
+         'cache', [({}, stats['bytes'])]),
+        ('catalog_thumbnail_evictions_total', 'counter', 'Files evicted '
+         'from the thumbnail cache', [({}, stats['evictions'])]),
+        ('catalog_thumbnail_fetches_total', 'counter', 'Pictures '
+         'downloaded', [({}, stats['fetches'])]),
+        ('catalog_thumbnail_collapsed_total', 'counter', 'Requests that '
+         'waited for a thumbnail another request was building',
+         [({}, stats['collapsed'])]),
+        ('catalog_thumbnail_errors_total', 'counter', 'Pictures that could '
+         'not be fetched or resized', [({}, stats['errors'])]),
+    ]
+
+
+def replicaMetrics():
+    stats = router.stats
+    return [
+        ('catalog_db_queries_total', 'counter', 'Queries by engine',
+         [({'engine': name}, count)
+          for name, count in sorted(stats['queries'].items())]),
+        ('catalog_replica_lag_seconds', 'gauge', 'Seconds since the last '
+         'heartbeat seen by each replica, -1 if unreachable',
+         [({'engine': name}, -1 if lag is None else lag)
+          for name, lag in sorted(stats['lag'].items())]),
+        ('catalog_replica_fallbacks_total', 'counter', 'Reads sent to the '
+         'primary because no replica was up to date',
+         [({}, stats['fallbacks'])]),
+        ('catalog_replica_heartbeat_writer', 'gauge', '1 if this process '
+         'writes the replica heartbeat',
+         [({}, int(stats['heartbeat_writer']))]),
+    ]
+
+
+metrics.add_collector(cacheMetrics)
+metrics.add_collector(jobMetrics)
+metrics.add_collector(sessionMetrics)
+metrics.add_collector(thumbnailMetrics)
+metrics.add_collector(replicaMetrics)
+
+
+@app.route('/metrics')
+def showMetrics():
+    return metrics_response(metrics)
+
 # ======================
 # Login protection
 # ======================
@@ -70,7 +352,8 @@ def showLogin():
     state = ''.join(random.choice(string.ascii_uppercase + string.digits)
                     for x in range(32))
     login_session['state'] = state
-    return render_template('login.html', STATE=state, input_id=CLIENT_ID)
+    return render_template('login.html', STATE=state,
+                           input_id=oauth.client_id())
 
 
 # ======================
@@ -90,10 +373,8 @@ def gconnect():
 
     try:
         # Upgrade the authorization code into a credentials object
-        oauth_flow = flow_from_clientsecrets('client_secrets.json', scope='')
-        oauth_flow.redirect_uri = 'postmessage'
-        credentials = oauth_flow.step2_exchange(code)
-    except FlowExchangeError:
+        credentials = oauth.exchange_code(code)
+    except oauth.CodeExchangeError:
         response = make_response(
             json.dumps('Failed to upgrade the authorization code.'), 401)
         response.headers['Content-Type'] = 'application/json'
@@ -101,10 +382,7 @@ def gconnect():
 
     # Check that the access token is valid.
     access_token = credentials.access_token
-    url = ('https://www.googleapis.com/oauth2/v1/tokeninfo?access_token=%s'
-           % access_token)
-    h = httplib2.Http()
-    result = json.loads(h.request(url, 'GET')[1])
+    result = oauth.get_token_info(access_token)
     # If there was an error in the access token info, abort.
     if result.get('error') is not None:
         response = make_response(json.dumps(result.get('error')), 500)
@@ -120,7 +398,7 @@ def gconnect():
         return response
 
     # Verify that the access token is valid for this app.
-    if result['issued_to'] != CLIENT_ID:
+    if result['issued_to'] != oauth.client_id():
         response = make_response(
             json.dumps("Token's client ID does not match app's."), 401)
         print("Token's client ID does not match app's.")
@@ -134,16 +412,15 @@ def gconnect():
         response.headers['Content-Type'] = 'application/json'
         return response
 
+    # A new session id for the logged in user
+    regenerateSession()
+
     # Store the access token in the session for later use.
     login_session['access_token'] = credentials.access_token
     login_session['gplus_id'] = gplus_id
 
     # Get user info
-    userinfo_url = "https://www.googleapis.com/oauth2/v1/userinfo"
-    params = {'access_token': credentials.access_token, 'alt': 'json'}
-    answer = requests.get(userinfo_url, params=params)
-
-    data = answer.json()
+    data = oauth.get_user_info(credentials.access_token)
 
     # Store session data
     login_session['username'] = data.get('name', '')
@@ -181,10 +458,7 @@ def gdisconnect():
             json.dumps('Current user not connected.'), 401)
         response.headers['Content-Type'] = 'application/json'
         return response
-    url = 'https://accounts.google.com/o/oauth2/revoke?token=%s' % access_token
-    h = httplib2.Http()
-    result = h.request(url, 'GET')[0]
-    if result['status'] == '200':
+    if oauth.revoke_token(access_token):
         # Reset the user's sesson.
         del login_session['access_token']
         del login_session['gplus_id']
@@ -192,6 +466,7 @@ def gdisconnect():
         del login_session['email']
         del login_session['picture']
         del login_session['user_id']
+        regenerateSession()
 
         response = redirect(url_for('showCatalog'))
         flash("You are now logged out.")
@@ -208,13 +483,46 @@ def gdisconnect():
 # User data functions
 # ======================
 
+# Users are cached per process by id and by email as plain records, since
+# ORM objects belong to the session that loaded them. Writes through the ORM
+# invalidate the cache, the TTL bounds staleness across workers.
+USER_CACHE_TTL = 300
+user_cache = TTLCache(ttl=USER_CACHE_TTL, maxsize=1024)
+CachedUser = collections.namedtuple('CachedUser', 'id name email picture')
+
+
+def cacheUser(user):
+    record = CachedUser(user.id, user.name, user.email, user.picture)
+    user_cache.set(('id', record.id), record)
+    user_cache.set(('email', record.email), record)
+    return record
+
+
+@event.listens_for(User, 'after_update')
+@event.listens_for(User, 'after_delete')
+def userChanged(mapper, connection, user):
+    user_cache.invalidate(('id', user.id))
+    user_cache.invalidate(('email', user.email))
+    # The email may have changed, drop the entry for the old one as well
+    old = inspect(user).attrs.email.history.deleted
+    if old:
+        user_cache.invalidate(('email', old[0]))
+
+
+def loadUser(key, criterion):
+    found, record = user_cache.lookup(key)
+    if not found:
+        user = session.query(User).filter(criterion).one_or_none()
+        if user is None:
+            return None
+        record = cacheUser(user)
+    return record
+
+
 # Check database for user email
 def getUserID(email):
-    try:
-        user = session.query(User).filter_by(email=email).one()
-        return user.id
-    except:
-        return None
+    user = loadUser(('email', email), User.email == email)
+    return user.id if user is not None else None
 
 
 # Add new user to database
@@ -222,15 +530,15 @@ def createUser(login_session):
     newUser = User(name=login_session['username'], email=login_session[
                    'email'], picture=login_session['picture'])
     session.add(newUser)
+    session.flush()
+    user = cacheUser(newUser)
     session.commit()
-    user = session.query(User).filter_by(email=login_session['email']).one()
     return user.id
 
 
 # Query user database by id
 def getUserInfo(user_id):
-    user = session.query(User).filter_by(id=user_id).one_or_none()
-    return user
+    return loadUser(('id', user_id), User.id == user_id)
 
 
 # ======================
@@ -240,7 +548,7 @@ def getUserInfo(user_id):
 @app.route('/')
 @app.route('/catalog/')
 def showCatalog():
-    categories = session.query(Category).order_by(asc(Category.name))
+    categories = getCategories()
     return render_template('catalog.html', categories=categories)
 
 
@@ -255,7 +563,7 @@ def showCategory(category_name):
     if category_name == 'items':
         return redirect(url_for('showAllItems'))
 
-    categories = session.query(Category).order_by(asc(Category.name))
+    categories = getCategories()
 
     # Redirect invalid URLs to main page
     try:
@@ -265,12 +573,11 @@ def showCategory(category_name):
 
     items = session.query(
             Items).filter_by(category=category).order_by(asc(Items.name)).all()
-    count = session.query(Items).filter_by(category=category).count()
     return render_template('categories.html',
                            category=category.name,
                            categories=categories,
                            items=items,
-                           count=count)
+                           count=category.item_count)
 
 
 # Add new category
@@ -289,6 +596,7 @@ def addCategory():
                                    user_id=login_session['user_id'])
             session.add(newCategory)
             session.commit()
+            catalogChanged('add category', newCategory.name)
             flash('Category Added Successfully')
             return redirect(url_for('showCatalog'))
     else:
@@ -301,17 +609,16 @@ def addCategory():
 def deleteCategory(category_name):
     categoryToDelete = session.query(
                                 Category).filter_by(name=category_name).one()
-    # See if the logged in user is the owner of item
-    creator = getUserInfo(categoryToDelete.user_id)
     # If logged in user != item owner redirect them
-    if creator.id != login_session['user_id']:
+    if categoryToDelete.user_id != login_session['user_id']:
         flash("You cannot delete this Category. This Category belongs to %s"
-              % creator.name)
+              % getUserInfo(categoryToDelete.user_id).name)
         return redirect(url_for('showCatalog'))
 
     if request.method == 'POST':
         session.delete(categoryToDelete)
         session.commit()
+        catalogChanged('delete category', categoryToDelete.name)
         flash('Category %s Deleted! ' % categoryToDelete.name)
         return redirect(url_for('showCatalog'))
     else:
@@ -326,13 +633,10 @@ def editCategory(category_name):
     editedCategory = session.query(
                         Category).filter_by(name=category_name).one()
     old_name = editedCategory.name
-    category = session.query(Category).filter_by(name=category_name).one()
-    # See if the logged in user is the owner of item
-    creator = getUserInfo(editedCategory.user_id)
     # If logged in user != item owner redirect them
-    if creator.id != login_session['user_id']:
+    if editedCategory.user_id != login_session['user_id']:
         flash("You cannot edit this Category. This Category belongs to %s"
-              % creator.name)
+              % getUserInfo(editedCategory.user_id).name)
         return redirect(url_for('showCatalog'))
 
     if request.method == 'POST':
@@ -346,12 +650,13 @@ def editCategory(category_name):
                 editedCategory.name = request.form['name']
         session.add(editedCategory)
         session.commit()
+        catalogChanged('edit category', editedCategory.name)
         flash('Category %s Edited to %s' % (old_name, editedCategory.name))
         return redirect(url_for('showCategory',
                                 category_name=editedCategory.name))
     else:
         return render_template('editcategory.html',
-                               category=category)
+                               category=editedCategory)
 
 
 # ======================
@@ -362,28 +667,73 @@ def editCategory(category_name):
 @app.route('/catalog/<path:category_name>/items/<path:item_name>/')
 def showItem(category_name, item_name):
     item = session.query(Items).filter_by(name=item_name).one()
-    categories = session.query(Category).order_by(asc(Category.name))
+    categories = getCategories()
     return render_template('items.html',
                            item=item,
                            category=category_name,
                            categories=categories)
 
 
+# All items are listed a page at a time, ordered by (name, id). The cursor
+# is the position of the last item on the previous page.
+ITEMS_PAGE_SIZE = 24
+
+
+def encodeCursor(item):
+    data = json.dumps([item.name, item.id]).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii')
+
+
+def decodeCursor(cursor):
+    try:
+        name, item_id = json.loads(base64.urlsafe_b64decode(
+            cursor.encode('ascii')).decode('utf-8'))
+        return name, int(item_id)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+def getItemsPage(cursor):
+    '''Returns a page of items after cursor and the cursor for the next'''
+    query = session.query(Items).options(
+        joinedload(Items.category)).order_by(asc(Items.name), asc(Items.id))
+    position = decodeCursor(cursor) if cursor else None
+    if position is not None:
+        name, item_id = position
+        query = query.filter(or_(Items.name > name,
+                                 and_(Items.name == name, Items.id > item_id)))
+    items = query.limit(ITEMS_PAGE_SIZE + 1).all()
+    if len(items) > ITEMS_PAGE_SIZE:
+        return items[:ITEMS_PAGE_SIZE], encodeCursor(
+            items[ITEMS_PAGE_SIZE - 1])
+    return items, None
+
+
 # Display all items in alphabetical order
 @app.route('/catalog/items')
 def showAllItems():
-    items = session.query(Items).order_by(asc(Items.name)).all()
-    categories = session.query(Category).order_by(asc(Category.name))
+    items, next_cursor = getItemsPage(request.args.get('cursor'))
+    categories = getCategories()
     return render_template('items_all.html',
                            items=items,
+                           next_cursor=next_cursor,
                            categories=categories)
 
 
+# Next page of the item list as an HTML fragment for infinite scrolling
+@app.route('/catalog/items/fragment')
+def showItemsFragment():
+    items, next_cursor = getItemsPage(request.args.get('cursor'))
+    return render_template('items_fragment.html',
+                           items=items,
+                           next_cursor=next_cursor)
+
+
 # Add an item
 @app.route('/catalog/add', methods=['GET', 'POST'])
 @login_required
 def addItem():
-    categories = session.query(Category).all()
+    categories = getCategories()
     if request.method == 'POST':
         newItem = Items(
             name=request.form['name'],
@@ -395,6 +745,7 @@ def addItem():
             user_id=login_session['user_id'])
         session.add(newItem)
         session.commit()
+        catalogChanged('add item', newItem.name)
         flash('Item %s added to Category %s'
               % (newItem.name, newItem.category.name))
         return redirect(url_for('showCategory',
@@ -410,13 +761,11 @@ def addItem():
 @login_required
 def editItem(category_name, item_name):
     editedItem = session.query(Items).filter_by(name=item_name).one()
-    categories = session.query(Category).all()
-    # See if the logged in user is the owner of item
-    creator = getUserInfo(editedItem.user_id)
+    categories = getCategories()
     # If logged in user != item owner redirect them
-    if creator.id != login_session['user_id']:
+    if editedItem.user_id != login_session['user_id']:
         flash("You cannot edit this item. This item belongs to %s"
-              % creator.name)
+              % getUserInfo(editedItem.user_id).name)
         return redirect(url_for('showCatalog'))
     if request.method == 'POST':
         # Not all forms are required - check to see what was updated
@@ -434,6 +783,7 @@ def editItem(category_name, item_name):
         editedItem.date = time
         session.add(editedItem)
         session.commit()
+        catalogChanged('edit item', editedItem.name)
         flash('Item %s Successfully Edited' % editedItem.name)
         return redirect(url_for('showItem',
                                 category_name=editedItem.category.name,
@@ -451,17 +801,15 @@ def editItem(category_name, item_name):
 def deleteItem(category_name, item_name):
     itemToDelete = session.query(Items).filter_by(name=item_name).one()
     category = session.query(Category).filter_by(name=category_name).one()
-    categories = session.query(Category).all()
-    # See if the logged in user is the owner of item
-    creator = getUserInfo(itemToDelete.user_id)
     # If logged in user != item owner redirect them
-    if creator.id != login_session['user_id']:
+    if itemToDelete.user_id != login_session['user_id']:
         flash("You cannot delete this item. This item belongs to %s"
-              % creator.name)
+              % getUserInfo(itemToDelete.user_id).name)
         return redirect(url_for('showCatalog'))
     if request.method == 'POST':
         session.delete(itemToDelete)
         session.commit()
+        catalogChanged('delete item', itemToDelete.name)
         flash('Deleted item %s' % itemToDelete.name)
         return redirect(url_for('showCategory',
                                 category_name=category.name))
@@ -470,46 +818,655 @@ def deleteItem(category_name, item_name):
                                item=itemToDelete)
 
 
+# ======================
+# Thumbnails
+# ======================
+
+# Item pictures are proxied through /media/thumb/<item_id>, fetched once
+# and kept in THUMBNAIL_DIR (a directory under the system temp dir by
+# default) up to THUMBNAIL_CACHE_MB. Pictures on private addresses are
+# refused unless THUMBNAIL_ALLOW_PRIVATE is set. The thumbnailer is
+# started by create_app.
+THUMBNAIL_SIZES = (160, 320, 640)
+DEFAULT_THUMBNAIL_SIZE = 320
+thumbnailer = None
+
+
+def pictureVersion(picture):
+    '''A short hash of a picture URL, so that thumbnail URLs change when
+    the picture does'''
+    return hashlib.sha1(picture.encode('utf-8')).hexdigest()[:12]
+
+
+def thumbnailUrl(item, size=DEFAULT_THUMBNAIL_SIZE):
+    '''Template global for the thumbnail URL of an item's picture'''
+    if not item.picture:
+        return ''
+    return url_for('itemThumbnail', item_id=item.id, size=size,
+                   v=pictureVersion(item.picture))
+
+
+# Thumbnail of an item's picture
+@app.route('/media/thumb/<int:item_id>')
+def itemThumbnail(item_id):
+    size = request.args.get('size', DEFAULT_THUMBNAIL_SIZE, type=int)
+    if size not in THUMBNAIL_SIZES:
+        return make_response('Unsupported size', 400)
+    picture = session.execute(select(item_table.c.picture).where(
+        item_table.c.id == item_id)).scalar()
+    if not picture:
+        return make_response('No picture', 404)
+    try:
+        thumbnail = thumbnailer.get(picture, size)
+    except ThumbnailError as e:
+        # The reason names the picture host, keep it out of the response
+        app.logger.warning('thumbnail of item %d unavailable: %s',
+                           item_id, e)
+        return make_response('Picture unavailable', 502)
+    versioned = request.args.get('v') == pictureVersion(picture)
+    response = send_file(thumbnail.path, mimetype=thumbnail.mimetype,
+                         etag=thumbnail.etag,
+                         last_modified=thumbnail.modified,
+                         max_age=31536000 if versioned else 0)
+    response.cache_control.public = True
+    if versioned:
+        response.cache_control.immutable = True
+    return response
+
+
+# ======================
+# Search
+# ======================
+
+SEARCH_PAGE_SIZE = 20
+SEARCH_SNIPPET_TOKENS = 12
+
+# Snippet highlight markers, replaced with <mark> after escaping
+MARK_START = '\x02'
+MARK_END = '\x03'
+
+SEARCH_QUERY = text('''
+    SELECT item.id, item.name, item.description, item.picture,
+           category.name AS category_name,
+           snippet(item_search, -1, :start, :end, '...', :tokens) AS snippet
+    FROM item_search
+    JOIN item ON item.id = item_search.rowid
+    JOIN category ON category.id = item.category_id
+    WHERE item_search MATCH :query
+    ORDER BY rank
+    LIMIT :limit OFFSET :offset''')
+
+
+def ftsQuery(terms):
+    '''Quotes each search term so user input can't break FTS5 syntax,
+    the last term matches as a prefix'''
+    words = ['"%s"' % w.replace('"', '""') for w in terms.split()]
+    if words:
+        words[-1] += '*'
+    return ' '.join(words)
+
+
+def highlight(snippet):
+    return Markup(escape(snippet)).replace(
+        MARK_START, Markup('<mark>')).replace(MARK_END, Markup('</mark>'))
+
+
+def searchItems(terms, page):
+    '''Returns a page of ranked search results and whether more follow'''
+    offset = (page - 1) * SEARCH_PAGE_SIZE
+    if SEARCH_ENABLED:
+        rows = session.execute(SEARCH_QUERY, {
+            'query': ftsQuery(terms), 'start': MARK_START, 'end': MARK_END,
+            'tokens': SEARCH_SNIPPET_TOKENS, 'limit': SEARCH_PAGE_SIZE + 1,
+            'offset': offset}).fetchall()
+        results = [{'id': r.id, 'name': r.name,
+                    'description': r.description, 'picture': r.picture,
+                    'category': r.category_name,
+                    'snippet': highlight(r.snippet)} for r in rows]
+    else:
+        # Databases without FTS5 fall back to an unranked LIKE scan
+        pattern = '%%%s%%' % terms
+        items = session.query(Items).join(Items.category).options(
+            contains_eager(Items.category)).filter(
+            or_(Items.name.ilike(pattern),
+                Items.description.ilike(pattern))).order_by(
+            asc(Items.name)).offset(offset).limit(
+            SEARCH_PAGE_SIZE + 1).all()
+        results = [{'id': i.id, 'name': i.name,
+                    'description': i.description, 'picture': i.picture,
+                    'category': i.category.name,
+                    'snippet': escape(i.description or '')} for i in items]
+    return results[:SEARCH_PAGE_SIZE], len(results) > SEARCH_PAGE_SIZE
+
+
+def getSearchArgs():
+    terms = request.args.get('q', '').strip()
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        page = 1
+    return terms, page
+
+
+# Search item names and descriptions
+@app.route('/catalog/search')
+def showSearch():
+    terms, page = getSearchArgs()
+    results, more = searchItems(terms, page) if terms else ([], False)
+    return render_template('search.html',
+                           query=terms,
+                           results=results,
+                           page=page,
+                           more=more,
+                           categories=getCategories())
+
+
+# JSON search results
+@app.route('/catalog/search/JSON')
+def searchJSON():
+    terms, page = getSearchArgs()
+    results, more = searchItems(terms, page) if terms else ([], False)
+    for r in results:
+        r['snippet'] = str(r['snippet'])
+    return jsonify(results=results, page=page,
+                   next=page + 1 if more else None)
+
+
 # ======================
 # JSON Endpoints
 # ======================
 
+# The read-only API selects the serialized columns with Core and encodes
+# plain rows with fastjson, no ORM objects are built. Keyset pagination is
+# opt-in through the `limit` and `after` query args. `after` is the cursor
+# returned as `next` by the previous page.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 500
+
+category_table = Category.__table__
+item_table = Items.__table__
+
+
+def isPaginated():
+    return 'limit' in request.args or 'after' in request.args
+
+
+def getPageArgs():
+    '''Returns (limit, after) from the query string, limit is None if invalid'''
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        return None, None
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        return None, None
+    return limit, request.args.get('after')
+
+
+def pageError():
+    response = make_response(
+        json.dumps('Invalid pagination parameters. limit must be between '
+                   '1 and %s.' % MAX_PAGE_SIZE), 400)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+def catalogRows():
+    '''Every category joined with its items, ordered by category id then
+    item id'''
+    return select(*(CATEGORY_COLUMNS + ITEM_COLUMNS)).select_from(
+        category_table.outerjoin(item_table)).order_by(
+        category_table.c.id, item_table.c.id)
+
+
+def groupCatalog(rows):
+    '''Yields serialized categories, with their serialized items under
+    'Items' if they have any, from catalogRows()'''
+    split = len(CATEGORY_COLUMNS)
+    category_keys = [c.name for c in CATEGORY_COLUMNS]
+    item_keys = [c.name for c in ITEM_COLUMNS]
+    category = None
+    for row in rows:
+        if category is None or row[0] != category['id']:
+            if category is not None:
+                yield category
+            category = dict(zip(category_keys, row[:split]))
+        if row[split] is not None:
+            category.setdefault('Items', []).append(
+                dict(zip(item_keys, row[split:])))
+    if category is not None:
+        yield category
+
+
 # All categories and items
 @app.route('/catalog/JSON')
+@response_cache.cached
 def allJSON():
-    categories = [c.serialize for c in session.query(Category).all()]
-    for i, c in enumerate(categories):
-        it = session.query(Items).filter_by(category_id=c['id']).all()
-        items = [i.serialize for i in it]
+    # Every category with its items in a single joined query
+    categories = list(groupCatalog(session.execute(catalogRows())))
+    return fastjson.response(Category=categories)
+
 
-        if items:
-            c['Items'] = items
-    return jsonify(Category=categories)
+# Full catalog as newline delimited JSON, one category per line
+@app.route('/catalog/JSON/stream')
+def allJSONStream():
+    def generate():
+        rows = session.execute(
+            catalogRows(), execution_options={'stream_results': True})
+        for category in groupCatalog(rows.yield_per(STREAM_BATCH_SIZE)):
+            yield json.dumps(category) + '\n'
+
+    return Response(stream_with_context(generate()),
+                    mimetype='application/x-ndjson')
 
 
 # JSON for all categories
 @app.route('/catalog/categories/JSON')
+@response_cache.cached
 def categoriesJSON():
-    categories = [c.serialize for c in session.query(Category).all()]
-    return jsonify(categories=categories)
+    query = select(*CATEGORY_COLUMNS)
+    if not isPaginated():
+        categories = serialize_rows(CATEGORY_COLUMNS, session.execute(query))
+        return fastjson.response(categories=categories)
+
+    limit, after = getPageArgs()
+    if limit is None:
+        return pageError()
+    query = query.order_by(category_table.c.name)
+    if after is not None:
+        query = query.where(category_table.c.name > after)
+    page = session.execute(query.limit(limit + 1)).all()
+    categories = serialize_rows(CATEGORY_COLUMNS, page[:limit])
+    cursor = categories[-1]['name'] if len(page) > limit else None
+    return fastjson.response(categories=categories, next=cursor)
 
 
 # JSON for all items within a category
 @app.route('/catalog/<path:category_name>/items/JSON')
+@response_cache.cached
 def categoryItemsJSON(category_name):
-    category = session.query(Category).filter_by(name=category_name).one()
-    items = [i.serialize for i in session.query(
-                                    Items).filter_by(category=category).all()]
-    return jsonify(items=items)
+    category_id = session.execute(select(category_table.c.id).where(
+        category_table.c.name == category_name)).scalar_one()
+    query = select(*ITEM_COLUMNS).where(
+        item_table.c.category_id == category_id)
+    if not isPaginated():
+        items = serialize_rows(ITEM_COLUMNS, session.execute(query))
+        return fastjson.response(items=items)
+
+    limit, after = getPageArgs()
+    if limit is None:
+        return pageError()
+    query = query.order_by(item_table.c.id)
+    if after is not None:
+        try:
+            query = query.where(item_table.c.id > int(after))
+        except ValueError:
+            return pageError()
+    page = session.execute(query.limit(limit + 1)).all()
+    items = serialize_rows(ITEM_COLUMNS, page[:limit])
+    cursor = items[-1]['id'] if len(page) > limit else None
+    return fastjson.response(items=items, next=cursor)
 
 
 # JSON for a single item
 @app.route('/catalog/<path:category_name>/items/<path:item_name>/JSON')
+@response_cache.cached
 def itemJSON(category_name, item_name):
-    item = session.query(Items).filter_by(name=item_name).one()
-    return jsonify(item=[item.serialize])
+    item = session.execute(select(*ITEM_COLUMNS).where(
+        item_table.c.name == item_name)).one()
+    return fastjson.response(item=serialize_rows(ITEM_COLUMNS, [item]))
+
+
+# ======================
+# Batch API
+# ======================
+
+# POST /catalog/batch takes {"operations": [...]} where each operation is
+#   {"op": "create", "type": "category" | "item", "data": {...}}
+#   {"op": "update", "type": ..., "id": 1 | "name": "...", "data": {...}}
+#   {"op": "delete", "type": ..., "id": 1 | "name": "..."}
+# Category data has a "name", item data "name", "description", "picture"
+# and "category" (a category name, which may be created earlier in the same
+# batch). Every operation is validated first and gets its own result, the
+# valid ones are applied in a single transaction.
+MAX_BATCH_SIZE = 5000
+BATCH_MODELS = {'category': Category, 'item': Items}
+ITEM_FIELDS = ('name', 'description', 'picture')
+
+
+def isMalformed(op):
+    '''Whether an operation is missing a field it needs or has a field
+    of the wrong type'''
+    if not isinstance(op, dict) or \
+            op.get('op') not in ('create', 'update', 'delete') or \
+            op.get('type') not in BATCH_MODELS or \
+            not isinstance(op.get('data', {}), dict):
+        return True
+    if op.get('id') is not None and \
+            (not isinstance(op['id'], int) or isinstance(op['id'], bool)):
+        return True
+    data = op.get('data', {})
+    strings = [op.get('name')] + \
+        [data.get(field) for field in ('category',) + ITEM_FIELDS]
+    if any(value is not None and not isinstance(value, str)
+           for value in strings):
+        return True
+    return op['op'] != 'create' and \
+        op.get('id') is None and op.get('name') is None
+
+
+def batchError(message, status=400):
+    response = make_response(json.dumps(message), status)
+    response.headers['Content-Type'] = 'application/json'
+    return response
+
+
+class BatchLookup(object):
+    '''Rows targeted or referenced by a batch, loaded with one query per
+    table and indexed by id and name'''
+
+    def __init__(self, operations):
+        ids = dict((t, set()) for t in BATCH_MODELS)
+        names = dict((t, set()) for t in BATCH_MODELS)
+        for op in operations:
+            if op.get('id') is not None:
+                ids[op['type']].add(op['id'])
+            if op.get('name') is not None:
+                names[op['type']].add(op['name'])
+            data = op.get('data', {})
+            if op['type'] == 'item' and data.get('category'):
+                names['category'].add(data['category'])
+            # Creates and renames must see the categories already named so
+            if op['type'] == 'category' and data.get('name'):
+                names['category'].add(data['name'])
+
+        self.by_id = {}
+        self.by_name = {}
+        for kind, model in BATCH_MODELS.items():
+            rows = []
+            if ids[kind] or names[kind]:
+                rows = session.query(model).filter(or_(
+                    model.id.in_(ids[kind]),
+                    model.name.in_(names[kind]))).all()
+            self.by_id[kind] = dict((r.id, r) for r in rows)
+            self.by_name[kind] = {}
+            for r in rows:
+                self.by_name[kind].setdefault(r.name, []).append(r)
+
+    def find(self, kind, op):
+        '''Returns (row, error) for the row an operation targets'''
+        if op.get('id') is not None:
+            row = self.by_id[kind].get(op['id'])
+        else:
+            rows = [r for r in self.by_name[kind].get(op.get('name'), [])
+                    if r not in session.deleted]
+            if len(rows) > 1:
+                return None, 'Name %r is ambiguous, use the id' % op['name']
+            row = rows[0] if rows else None
+        if row is None or row in session.deleted:
+            return None, 'No %s matches' % kind
+        return row, None
+
+    def category(self, name):
+        rows = [r for r in self.by_name['category'].get(name, [])
+                if r not in session.deleted]
+        return rows[0] if rows else None
+
+    def rename(self, kind, row, old_name):
+        self.by_name[kind][old_name].remove(row)
+        self.by_name[kind].setdefault(row.name, []).append(row)
+
+    def remove(self, kind, row):
+        self.by_id[kind].pop(row.id, None)
+        self.by_name[kind][row.name].remove(row)
+
+    def add(self, kind, row):
+        self.by_name[kind].setdefault(row.name, []).append(row)
+
+
+def applyOperation(op, lookup, user_id):
+    '''Applies one operation to the session. Returns (status, row) on
+    success, or ('error', message)'''
+    kind = op['type']
+    data = op.get('data') or {}
+
+    if op['op'] == 'create':
+        if not data.get('name'):
+            return 'error', 'A name is required'
+        if kind == 'category':
+            if lookup.category(data['name']) is not None:
+                return 'error', 'Category %r already exists' % data['name']
+            row = Category(name=data['name'], user_id=user_id)
+        else:
+            category = lookup.category(data.get('category'))
+            if category is None:
+                return 'error', 'No category %r' % data.get('category')
+            row = Items(category=category, date=datetime.datetime.now(),
+                        user_id=user_id,
+                        **dict((f, data.get(f)) for f in ITEM_FIELDS))
+        session.add(row)
+        lookup.add(kind, row)
+        return 'created', row
+
+    row, error = lookup.find(kind, op)
+    if error:
+        return 'error', error
+    if row.user_id != user_id:
+        return 'error', 'This %s belongs to another user' % kind
+
+    if op['op'] == 'delete':
+        if row in session.new:
+            # Created earlier in this batch, so there is nothing to delete
+            if kind == 'item':
+                row.category.item.remove(row)
+            session.expunge(row)
+        else:
+            session.delete(row)
+        lookup.remove(kind, row)
+        return 'deleted', row
+
+    old_name = row.name
+    if kind == 'category':
+        if data.get('name') and data['name'] != row.name:
+            if lookup.category(data['name']) is not None:
+                return 'error', 'Category %r already exists' % data['name']
+            row.name = data['name']
+    else:
+        if data.get('category'):
+            category = lookup.category(data['category'])
+            if category is None:
+                return 'error', 'No category %r' % data['category']
+            row.category = category
+        for field in ITEM_FIELDS:
+            if data.get(field):
+                setattr(row, field, data[field])
+        row.date = datetime.datetime.now()
+    if row.name != old_name:
+        lookup.rename(kind, row, old_name)
+    return 'updated', row
+
+
+# Create, update and delete many categories and items in one transaction
+@app.route('/catalog/batch', methods=['POST'])
+@login_required
+def batchWrite():
+    payload = request.get_json(silent=True)
+    operations = payload.get('operations') \
+        if isinstance(payload, dict) else None
+    if not isinstance(operations, list):
+        return batchError('Expected a JSON object with an operations list.')
+    if len(operations) > MAX_BATCH_SIZE:
+        return batchError('At most %d operations are allowed per batch.'
+                          % MAX_BATCH_SIZE, 413)
+    for n, op in enumerate(operations):
+        if isMalformed(op):
+            return batchError('Operation %d is malformed.' % n)
+
+    user_id = login_session['user_id']
+    lookup = BatchLookup(operations)
+    outcomes = []
+    with session.no_autoflush:
+        for op in operations:
+            outcomes.append(applyOperation(op, lookup, user_id))
+
+    try:
+        session.flush()
+        results = []
+        for n, (status, value) in enumerate(outcomes):
+            if status == 'error':
+                results.append({'index': n, 'status': status,
+                                'error': value})
+            else:
+                results.append({'index': n, 'status': status,
+                                'id': value.id})
+        session.commit()
+    except IntegrityError as e:
+        session.rollback()
+        return batchError('The batch conflicts with existing data and was '
+                          'not applied: %s' % e.orig, 409)
+
+    applied = sum(1 for status, value in outcomes if status != 'error')
+    if applied:
+        catalogChanged('batch', '%d operations' % applied)
+    return jsonify(results=results, applied=applied,
+                   errors=len(outcomes) - applied)
+
+# ======================
+# App Factory
+# ======================
+
+# Settings read by create_app. Each one comes from the config passed to
+# create_app, then the environment variable of the same name, then the
+# default here.
+DEFAULT_CONFIG = {
+    'DATABASE_URL': None,
+    'CREATE_SCHEMA': True,
+    'RESPONSE_CACHE_DIR': None,
+    'RESPONSE_CACHE_TTL': 30,
+    'RESPONSE_CACHE_VERSION': 'catalog_version',
+    'TEMPLATE_CACHE_DIR': None,
+    'PRECOMPILE_TEMPLATES': False,
+    'JOB_OUTBOX': 'outbox.db',
+    'JOB_WORKERS': 2,
+    'SESSION_STORE': 'sqlite',
+    'SESSION_DB': 'sessions.db',
+    'SESSION_TTL': 86400,
+    'PROFILE_REQUESTS': False,
+    'PROFILE_SAMPLE_DIR': None,
+    'PROFILE_SLOW_MS': 500,
+    'COMPRESS_RESPONSES': True,
+    'COMPRESS_MIN_SIZE': 1024,
+    'COMPRESS_LEVEL': 6,
+    'THUMBNAIL_DIR': None,
+    'THUMBNAIL_CACHE_MB': 256,
+    'THUMBNAIL_WORKERS': 4,
+    'THUMBNAIL_ALLOW_PRIVATE': False,
+    'READ_REPLICAS': '',
+    'REPLICA_MAX_LAG': 5,
+    'REPLICA_HEARTBEAT_INTERVAL': 1,
+    'REPLICA_STICKY_SECONDS': 10,
+}
+
+
+def getSetting(config, name):
+    if name in config:
+        return config[name]
+    return os.environ.get(name, DEFAULT_CONFIG[name])
+
+
+def isEnabled(value):
+    return value in (True, 1, '1', 'true', 'yes')
+
+
+def create_app(config=None):
+    '''Connects the app to its database, caches, job queue and session
+    store and returns it. Nothing touches the disk or network before this
+    runs. Items in config are also set on app.config. The app is module
+    global, so later calls return it and raise RuntimeError if their
+    config differs'''
+    global engine, SEARCH_ENABLED, jobs, SESSION_STORE, thumbnailer, router
+    global REPLICA_STICKY_SECONDS
+    config = dict(config or {})
+    if 'catalog' in app.extensions:
+        if config != app.extensions['catalog']:
+            raise RuntimeError('create_app() was already called with a '
+                               'different config')
+        return app
+    app.config.update(config)
+
+    def setting(name):
+        return getSetting(config, name)
+
+    engine = get_engine(setting('DATABASE_URL'))
+    Base.metadata.bind = engine
+    if isEnabled(setting('CREATE_SCHEMA')):
+        SEARCH_ENABLED = init_database(engine)
+    else:
+        SEARCH_ENABLED = search_available(engine)
+
+    if setting('RESPONSE_CACHE_DIR'):
+        response_cache.backend = FileBackend(setting('RESPONSE_CACHE_DIR'))
+    else:
+        response_cache.backend = MemoryBackend(
+            ttl=float(setting('RESPONSE_CACHE_TTL')),
+            version_file=setting('RESPONSE_CACHE_VERSION') or None)
+
+    router = Router.from_urls(
+        engine, [url.strip() for url in setting('READ_REPLICAS').split(',')
+                 if url.strip()],
+        max_lag=float(setting('REPLICA_MAX_LAG')),
+        heartbeat_interval=float(setting('REPLICA_HEARTBEAT_INTERVAL')),
+        last_commit=response_cache.backend.changed_at)
+    router.start()
+    REPLICA_STICKY_SECONDS = float(setting('REPLICA_STICKY_SECONDS'))
+    session.configure(bind=engine, router=router)
+
+    templating.init_app(app, fragment_cache, fragmentCacheKey,
+                        setting('TEMPLATE_CACHE_DIR'))
+    app.jinja_env.globals['thumbnailUrl'] = thumbnailUrl
+    if isEnabled(setting('PRECOMPILE_TEMPLATES')):
+        templating.precompile(app)
+
+    jobs = JobQueue(setting('JOB_OUTBOX'),
+                    workers=int(setting('JOB_WORKERS')))
+    jobs.handler('catalog_changed')(catalogChangedJob)
+
+    thumbnailer = Thumbnailer(
+        setting('THUMBNAIL_DIR'),
+        max_bytes=int(setting('THUMBNAIL_CACHE_MB')) * 1024 * 1024,
+        workers=int(setting('THUMBNAIL_WORKERS')),
+        allow_private=isEnabled(setting('THUMBNAIL_ALLOW_PRIVATE')))
+
+    SESSION_STORE = setting('SESSION_STORE')
+    if SESSION_STORE == 'sqlite':
+        app.session_interface = ServerSessionInterface(
+            SQLiteStore(setting('SESSION_DB')),
+            ttl=int(setting('SESSION_TTL')))
+    elif SESSION_STORE == 'memory':
+        app.session_interface = ServerSessionInterface(
+            MemoryStore(), ttl=int(setting('SESSION_TTL')))
+    elif SESSION_STORE != 'cookie':
+        raise ValueError('Unknown SESSION_STORE %r' % SESSION_STORE)
+
+    if isEnabled(setting('PROFILE_REQUESTS')):
+        profiler = Profiler(metrics,
+                            sample_dir=setting('PROFILE_SAMPLE_DIR'),
+                            slow_ms=int(setting('PROFILE_SLOW_MS')))
+        profiler.init_app(app)
+        for watched in router.engines:
+            profiler.watch_engine(watched)
+
+    if isEnabled(setting('COMPRESS_RESPONSES')):
+        compressor.min_size = int(setting('COMPRESS_MIN_SIZE'))
+        compressor.level = int(setting('COMPRESS_LEVEL'))
+        compressor.init_app(app)
+    static_assets.init_app(app)
+
+    app.extensions['catalog'] = config
+    return app
+
 
 if __name__ == '__main__':
-    app.secret_key = 'super_secret_key'
+    app = create_app({'SECRET_KEY': 'super_secret_key'})
     app.debug = True
     app.run(host='0.0.0.0', port=5000)
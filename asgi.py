@@ -0,0 +1,137 @@
+#!/usr/bin/env python3.7
+# ASGI entry point for async serving, e.g. `uvicorn asgi:application`
+#
+# The read-only JSON endpoints are answered by async handlers on an
+# aiosqlite engine, so slow clients don't tie up a worker thread each.
+# Every other request, including the HTML pages and the OAuth routes, goes
+# to the unchanged Flask app, which asgiref runs in a thread pool off the
+# event loop.
+#
+# Requires the optional aiosqlite and asgiref packages.
+import hashlib
+import os
+import re
+
+try:
+    from asgiref.wsgi import WsgiToAsgi
+    from sqlalchemy.ext.asyncio import create_async_engine
+    import aiosqlite  # noqa: F401, the driver for sqlite+aiosqlite URLs
+except ImportError as e:
+    raise ImportError('async serving needs the aiosqlite and asgiref '
+                      'packages: %s' % e)
+
+from sqlalchemy import select
+from database_setup import (CATEGORY_COLUMNS, ITEM_COLUMNS, Category, Items,
+                            serialize_rows)
+import app as catalog
+import fastjson
+
+flask_app = catalog.create_app()
+ASYNC_DATABASE_URL = os.environ.get(
+    'ASYNC_DATABASE_URL',
+    catalog.engine.url.render_as_string(hide_password=False).replace(
+        'sqlite://', 'sqlite+aiosqlite://', 1))
+
+engine = create_async_engine(ASYNC_DATABASE_URL)
+wsgi = WsgiToAsgi(flask_app)
+
+
+# ======================
+# Async JSON handlers
+# ======================
+
+async def allJSON(conn):
+    rows = await conn.execute(catalog.catalogRows())
+    return {'Category': list(catalog.groupCatalog(rows))}
+
+
+async def categoriesJSON(conn):
+    rows = await conn.execute(select(*CATEGORY_COLUMNS))
+    return {'categories': serialize_rows(CATEGORY_COLUMNS, rows)}
+
+
+async def getCategoryId(conn, category_name):
+    return (await conn.execute(select(Category.id).where(
+        Category.name == category_name))).scalar()
+
+
+async def categoryItemsJSON(conn, category_name):
+    category_id = await getCategoryId(conn, category_name)
+    if category_id is None:
+        return None
+    rows = await conn.execute(select(*ITEM_COLUMNS).where(
+        Items.category_id == category_id))
+    return {'items': serialize_rows(ITEM_COLUMNS, rows)}
+
+
+async def itemJSON(conn, category_name, item_name):
+    row = (await conn.execute(select(*ITEM_COLUMNS).where(
+        Items.name == item_name))).first()
+    if row is None:
+        return None
+    return {'item': serialize_rows(ITEM_COLUMNS, [row])}
+
+
+# Routes with the same paths as app.py, most specific first
+ROUTES = [
+    (re.compile(r'^/catalog/JSON$'), allJSON),
+    (re.compile(r'^/catalog/categories/JSON$'), categoriesJSON),
+    (re.compile(r'^/catalog/(.+)/items/(.+)/JSON$'), itemJSON),
+    (re.compile(r'^/catalog/(.+)/items/JSON$'), categoryItemsJSON),
+]
+
+
+def match(scope):
+    """Return (handler, args) for requests served asynchronously. Paginated
+    requests (any query string) are left to the Flask app"""
+    if scope['method'] not in ('GET', 'HEAD') or scope['query_string']:
+        return None, None
+    for pattern, handler in ROUTES:
+        m = pattern.match(scope['path'])
+        if m:
+            return handler, m.groups()
+    return None, None
+
+
+async def send_json(scope, send, status, body):
+    # Encoded like flask.jsonify, with a strong ETag for conditional GETs
+    data = fastjson.dumps(body) + b'\n'
+    response_headers = [(b'content-type', b'application/json')]
+    if status == 200:
+        etag = '"%s"' % hashlib.sha1(data).hexdigest()
+        if_none_match = dict(scope['headers']).get(b'if-none-match', b'')
+        if etag in [t.strip() for t in
+                    if_none_match.decode('latin-1').split(',')]:
+            status, data = 304, b''
+        response_headers += [(b'etag', etag.encode()),
+                             (b'cache-control', b'no-cache')]
+    response_headers.append((b'content-length', str(len(data)).encode()))
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': response_headers})
+    await send({'type': 'http.response.body',
+                'body': b'' if scope['method'] == 'HEAD' else data})
+
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await engine.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+    if scope['type'] == 'http':
+        handler, args = match(scope)
+        if handler is not None:
+            async with engine.connect() as conn:
+                body = await handler(conn, *args)
+            if body is None:
+                return await send_json(scope, send, 404, 'Not found.')
+            return await send_json(scope, send, 200, body)
+    return await wsgi(scope, receive, send)
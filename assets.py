@@ -0,0 +1,149 @@
+#!/usr/bin/env python3.7
+# Fingerprinted and precompressed static files
+#
+# Usage: python assets.py [--static DIR]
+#
+# Copies every file under static/ into static/build/ with a hash of its
+# contents in the name, so styles.css becomes styles.<hash>.css, writes gzip
+# (and brotli, when it is installed) copies of compressible files next to
+# it, and records them in static/build/manifest.json. Once the manifest
+# exists url_for('static', filename='styles.css') points to the
+# fingerprinted file, which is served precompressed with far-future
+# immutable cache headers. Run it again whenever a static file changes.
+import argparse
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import shutil
+
+from flask import request, send_from_directory
+
+import compression
+
+BUILD_DIR = 'build'
+MANIFEST = 'manifest.json'
+HASH_LENGTH = 12
+SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def guess_type(filename):
+    return mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+
+
+def fingerprint(name, data):
+    """styles.css -> styles.<hash>.css"""
+    root, ext = os.path.splitext(name)
+    digest = hashlib.sha256(data).hexdigest()[:HASH_LENGTH]
+    return '%s.%s%s' % (root, digest, ext)
+
+
+def precompress(data, encoding):
+    if encoding == 'br':
+        return compression.brotli.compress(data, quality=11)
+    return gzip.compress(data, 9, mtime=0)
+
+
+def build(static_dir):
+    """Build static_dir/build and its manifest, return the manifest"""
+    build_dir = os.path.join(static_dir, BUILD_DIR)
+    if os.path.isdir(build_dir):
+        shutil.rmtree(build_dir)
+    os.makedirs(build_dir)
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_dir):
+        if root == static_dir and BUILD_DIR in dirs:
+            dirs.remove(BUILD_DIR)
+        for filename in sorted(files):
+            source = os.path.join(root, filename)
+            name = os.path.relpath(source, static_dir).replace(os.sep, '/')
+            with open(source, 'rb') as f:
+                data = f.read()
+            built = fingerprint(name, data)
+            target = os.path.join(build_dir, built)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                f.write(data)
+
+            encodings = []
+            if guess_type(name) in compression.COMPRESSIBLE_TYPES:
+                for encoding in compression.encodings():
+                    compressed = precompress(data, encoding)
+                    # Not worth it for tiny files
+                    if len(compressed) < len(data):
+                        with open(target + SUFFIXES[encoding], 'wb') as f:
+                            f.write(compressed)
+                        encodings.append(encoding)
+            manifest[name] = {'path': built, 'encodings': encodings}
+
+    with open(os.path.join(build_dir, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class StaticAssets(object):
+    """Points url_for('static') at the fingerprinted copies of static
+    files and serves them. Without a manifest static files are served as
+    usual"""
+
+    def __init__(self):
+        self.manifest = {}
+        self.built = {}
+
+    def init_app(self, app):
+        self.app = app
+        self.build_dir = os.path.join(app.static_folder, BUILD_DIR)
+        try:
+            with open(os.path.join(self.build_dir, MANIFEST)) as f:
+                self.manifest = json.load(f)
+        except (IOError, ValueError):
+            return
+        self.built = dict(('%s/%s' % (BUILD_DIR, entry['path']), entry)
+                          for entry in self.manifest.values())
+        app.url_defaults(self.url_defaults)
+        app.view_functions['static'] = self.send_static
+
+    def url_defaults(self, endpoint, values):
+        if endpoint == 'static':
+            entry = self.manifest.get(values.get('filename'))
+            if entry is not None:
+                values['filename'] = '%s/%s' % (BUILD_DIR, entry['path'])
+
+    def send_static(self, filename):
+        entry = self.built.get(filename)
+        if entry is None:
+            return self.app.send_static_file(filename)
+
+        encoding = request.accept_encodings.best_match(entry['encodings'])
+        path = entry['path'] + (SUFFIXES[encoding] if encoding else '')
+        response = send_from_directory(self.build_dir, path,
+                                       mimetype=guess_type(entry['path']),
+                                       max_age=IMMUTABLE_MAX_AGE)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        if entry['encodings']:
+            response.vary.add('Accept-Encoding')
+        response.cache_control.public = True
+        response.cache_control.immutable = True
+        return response
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Fingerprint and precompress static files')
+    parser.add_argument('--static', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), 'static'),
+        help='static directory, static/ next to this file by default')
+    args = parser.parse_args(argv)
+
+    manifest = build(args.static)
+    for name, entry in sorted(manifest.items()):
+        print('%s -> %s/%s %s' % (name, BUILD_DIR, entry['path'],
+                                  ' '.join(entry['encodings'])))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3.7
+# Concurrent read/write load test comparing SQLite rollback journal and WAL
+#
+# Usage: python benchmarks/concurrent_sqlite.py [seconds] [readers] [writers]
+import os
+import sys
+import time
+import datetime
+import tempfile
+import multiprocessing
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import select, func
+from sqlalchemy.exc import OperationalError
+from database_setup import Base, Category, Items, get_engine
+
+ROWS = 5000
+
+
+def setup(path, wal):
+    engine = get_engine('sqlite:///' + path, wal=wal)
+    Base.metadata.create_all(engine)
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        conn.execute(Category.__table__.insert(), [
+            {'name': 'category %d' % n, 'user_id': 1} for n in range(100)])
+        conn.execute(Items.__table__.insert(), [
+            {'name': 'item %d' % n, 'date': now, 'user_id': 1,
+             'category_id': n % 100 + 1} for n in range(ROWS)])
+    engine.dispose()
+
+
+def worker(path, wal, writer, seconds, results):
+    engine = get_engine('sqlite:///' + path, wal=wal)
+    ops = errors = n = 0
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        n += 1
+        try:
+            with engine.begin() as conn:
+                if writer:
+                    conn.execute(Items.__table__.update().where(
+                        Items.id == n % ROWS + 1).values(
+                        description='edited %d' % n))
+                else:
+                    conn.execute(select(Items.name).where(
+                        Items.category_id == n % 100 + 1)).fetchall()
+                    conn.execute(select(func.count(Items.id))).scalar()
+            ops += 1
+        except OperationalError:
+            errors += 1
+    results.put((writer, ops, errors))
+
+
+def run(wal, seconds, readers, writers):
+    path = tempfile.mktemp(suffix='.db')
+    setup(path, wal)
+    results = multiprocessing.Queue()
+    procs = [multiprocessing.Process(
+                target=worker, args=(path, wal, n < writers, seconds, results))
+             for n in range(readers + writers)]
+    for p in procs:
+        p.start()
+    totals = {True: [0, 0], False: [0, 0]}
+    for p in procs:
+        writer, ops, errors = results.get()
+        totals[writer][0] += ops
+        totals[writer][1] += errors
+    for p in procs:
+        p.join()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return totals
+
+
+def main(seconds=5, readers=4, writers=2):
+    print('%-10s %12s %12s %14s' % ('mode', 'reads/sec', 'writes/sec',
+                                    'locked errors'))
+    for label, wal in (('rollback', False), ('wal', True)):
+        totals = run(wal, seconds, readers, writers)
+        print('%-10s %12.0f %12.0f %14d' % (
+            label, totals[False][0] / seconds, totals[True][0] / seconds,
+            totals[False][1] + totals[True][1]))
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3.7
+# Measure the cold start of a worker: importing app.py and create_app()
+#
+# Usage: python benchmarks/importtime.py [runs] [--top N]
+#
+# Every run starts a fresh interpreter with `python -X importtime` in an
+# empty temporary directory. The median import time of `app` and of its
+# heaviest dependencies is reported, then the time create_app() takes to
+# open the database, job outbox and session store.
+import argparse
+import os
+import re
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+
+IMPORTTIME = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+SCRIPT = '''
+import time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.create_app()
+print('create_app %f' % (time.perf_counter() - imported))
+print('import %f' % (imported - start))
+'''
+
+
+def run(workdir):
+    """Return (import seconds, create_app seconds, {module: cumulative
+    microseconds}) for one fresh interpreter"""
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    env.setdefault('DATABASE_URL', 'sqlite:///' + os.path.join(
+        workdir, 'bench.db'))
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                             SCRIPT], cwd=workdir, env=env,
+                            capture_output=True, text=True, check=True)
+    modules = {}
+    for line in result.stderr.splitlines():
+        m = IMPORTTIME.match(line)
+        # Only top level imports, nested ones are included in their parents
+        if m and len(m.group(3)) <= 3:
+            modules[m.group(4)] = int(m.group(2))
+    timings = dict(line.split() for line in result.stdout.splitlines())
+    return float(timings['import']), float(timings['create_app']), modules
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('runs', nargs='?', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15,
+                        help='number of modules to list')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='catalog-importtime-')
+    try:
+        shutil.copy(os.path.join(ROOT, 'client_secrets_fake.json'),
+                    os.path.join(workdir, 'client_secrets.json'))
+        # The first run compiles bytecode and creates the database
+        run(workdir)
+        imports, creates, modules = [], [], {}
+        for n in range(args.runs):
+            imported, created, timings = run(workdir)
+            imports.append(imported)
+            creates.append(created)
+            for name, micros in timings.items():
+                modules.setdefault(name, []).append(micros)
+    finally:
+        shutil.rmtree(workdir)
+
+    print('import app    %8.1f ms (median of %d)'
+          % (statistics.median(imports) * 1000, args.runs))
+    print('create_app()  %8.1f ms' % (statistics.median(creates) * 1000))
+    print('\nslowest imports (cumulative ms)')
+    medians = sorted(((statistics.median(v) / 1000.0, k)
+                      for k, v in modules.items()), reverse=True)
+    for ms, name in medians[:args.top]:
+        print('  %-40s %8.1f' % (name, ms))
+
+
+if __name__ == '__main__':
+    main()
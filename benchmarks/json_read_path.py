@@ -0,0 +1,100 @@
+#!/usr/bin/env python3.7
+# Compare the ORM and Core read paths of the JSON API
+#
+# Usage: python benchmarks/json_read_path.py [items] [runs]
+#
+# Builds the /catalog/JSON document for a synthetic catalog three ways: the
+# previous ORM path (Category objects with contains_eager, serialize and
+# json.dumps), the Core path encoded with the standard library, and the
+# Core path encoded with fastjson (orjson when it is installed). Reports
+# rows/sec over the best of `runs` and the memory allocated per build, and
+# checks that all three produce the same bytes.
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy.orm import contains_eager, sessionmaker
+from database_setup import Category, Items, get_engine
+from routes import generate
+import app
+import fastjson
+
+
+def ormPath(session):
+    rows = session.query(Category).outerjoin(Category.item).options(
+        contains_eager(Category.item)).order_by(Category.id, Items.id).all()
+    categories = []
+    for c in rows:
+        category = c.serialize
+        items = [i.serialize for i in c.item]
+        if items:
+            category['Items'] = items
+        categories.append(category)
+    return json.dumps({'Category': categories}, sort_keys=True,
+                      separators=(',', ':')).encode('ascii')
+
+
+def corePath(session):
+    categories = list(app.groupCatalog(session.execute(app.catalogRows())))
+    return json.dumps({'Category': categories}, sort_keys=True,
+                      separators=(',', ':')).encode('ascii')
+
+
+def coreFastPath(session):
+    categories = list(app.groupCatalog(session.execute(app.catalogRows())))
+    return fastjson.dumps({'Category': categories})
+
+
+def measure(Session, build, runs):
+    """Return (best seconds, peak bytes allocated, output)"""
+    best = None
+    for n in range(runs):
+        session = Session()
+        start = time.perf_counter()
+        output = build(session)
+        elapsed = time.perf_counter() - start
+        session.close()
+        best = elapsed if best is None else min(best, elapsed)
+    session = Session()
+    tracemalloc.start()
+    build(session)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    session.close()
+    return best, peak, output
+
+
+def main(items=100000, runs=5):
+    path = tempfile.mktemp(suffix='.db')
+    try:
+        generate('sqlite:///' + path, items)
+        engine = get_engine('sqlite:///' + path)
+        Session = sessionmaker(bind=engine)
+        paths = [('orm + json', ormPath), ('core + json', corePath),
+                 ('core + %s' % ('orjson' if fastjson.orjson else 'json'),
+                  coreFastPath)]
+        print('%d items, best of %d runs' % (items, runs))
+        print('%-16s %12s %12s %14s' % ('path', 'ms', 'rows/sec',
+                                         'peak alloc MB'))
+        outputs = []
+        for label, build in paths:
+            best, peak, output = measure(Session, build, runs)
+            outputs.append(output)
+            print('%-16s %12.1f %12.0f %14.1f' % (
+                label, best * 1000, items / best, peak / 1048576.0))
+        if any(output != outputs[0] for output in outputs):
+            print('outputs differ!')
+            raise SystemExit(1)
+        print('outputs are identical (%d bytes)' % len(outputs[0]))
+        engine.dispose()
+    finally:
+        os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3.7
+# Benchmark name/email lookups with and without the model indexes
+#
+# Usage: python benchmarks/lookup_indexes.py [sizes...]
+import os
+import sys
+import time
+import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.orm import sessionmaker
+from database_setup import Base, User, Category, Items
+
+LOOKUPS = 200
+
+
+def build(size, indexed):
+    engine = create_engine('sqlite://')
+    Base.metadata.create_all(engine)
+    if not indexed:
+        with engine.begin() as conn:
+            for table in Base.metadata.sorted_tables:
+                for index in table.indexes:
+                    conn.execute(text('DROP INDEX %s' % index.name))
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {'name': 'user %d' % n, 'email': 'user%d@example.com' % n}
+            for n in range(size)])
+        conn.execute(Category.__table__.insert(), [
+            {'name': 'category %d' % n, 'user_id': 1}
+            for n in range(size)])
+        conn.execute(Items.__table__.insert(), [
+            {'name': 'item %d' % n, 'date': now, 'user_id': 1,
+             'category_id': n % size + 1}
+            for n in range(size)])
+    return sessionmaker(bind=engine)()
+
+
+def timeLookups(session, size):
+    step = max(size // LOOKUPS, 1)
+    keys = range(0, size, step)
+    timings = {}
+    lookups = [
+        ('Category.name', lambda n: session.query(Category).filter_by(
+            name='category %d' % n).one()),
+        ('Items.name', lambda n: session.query(Items).filter_by(
+            name='item %d' % n).one()),
+        ('User.email', lambda n: session.query(User).filter_by(
+            email='user%d@example.com' % n).one()),
+    ]
+    for label, lookup in lookups:
+        start = time.perf_counter()
+        for n in keys:
+            lookup(n)
+        timings[label] = (time.perf_counter() - start) / len(keys) * 1e6
+    return timings
+
+
+def main(sizes):
+    print('%-10s %-15s %14s %14s' % ('rows', 'lookup',
+                                     'no index (us)', 'indexed (us)'))
+    for size in sizes:
+        plain = timeLookups(build(size, False), size)
+        indexed = timeLookups(build(size, True), size)
+        for label in plain:
+            print('%-10d %-15s %14.1f %14.1f'
+                  % (size, label, plain[label], indexed[label]))
+
+
+if __name__ == '__main__':
+    main([int(a) for a in sys.argv[1:]] or [1000, 10000, 100000])
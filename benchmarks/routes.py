@@ -0,0 +1,354 @@
+#!/usr/bin/env python3.7
+# Load test every route in app.py against a synthetic catalog
+#
+# Usage: python benchmarks/routes.py [--size small|medium|large]
+#            [--mode client|server|both] [--requests N] [--concurrency N]
+#            [--save-baseline FILE] [--compare FILE] [--tolerance 0.2]
+#
+# The catalog is generated in a temporary directory, which is also the
+# working directory of the app while it runs. Login protected routes use a
+# stubbed session instead of Google sign in, so gconnect and gdisconnect are
+# the only routes not exercised.
+import argparse
+import datetime
+import http.client
+import json
+import os
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from socketserver import ThreadingMixIn
+from urllib.parse import quote, urlencode
+from wsgiref.simple_server import WSGIRequestHandler, WSGIServer, make_server
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, ROOT)
+
+SIZES = {'small': 1000, 'medium': 100000, 'large': 1000000}
+USERS = 10
+WORDS = ('linear recurrent convolutional gated unit layer network attention '
+         'residual dense sparse batch norm dropout pooling kernel').split()
+
+
+# ======================
+# Synthetic catalog
+# ======================
+
+def generate(url, items):
+    """Fill the database at url with USERS users, items / 100 categories
+    and items items. Returns (category names, (category, item) names)"""
+    from database_setup import (Base, User, Category, Items, get_engine,
+                                setup_search, repair_item_counts)
+    engine = get_engine(url)
+    Base.metadata.create_all(engine)
+    setup_search(engine)
+    categories = max(items // 100, 10)
+    rng = random.Random(0)
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), [
+            {'name': 'user %d' % n, 'email': 'user%d@example.com' % n,
+             'picture': ''} for n in range(USERS)])
+        conn.execute(Category.__table__.insert(), [
+            {'name': 'category %d' % n, 'user_id': n % USERS + 1}
+            for n in range(categories)])
+        for start in range(0, items, 50000):
+            conn.execute(Items.__table__.insert(), [
+                {'name': 'item %d' % n,
+                 'description': ' '.join(rng.choice(WORDS)
+                                         for w in range(12)),
+                 'picture': 'https://example.com/%d.png' % n,
+                 'date': now, 'user_id': n % USERS + 1,
+                 'category_id': n % categories + 1}
+                for n in range(start, min(start + 50000, items))])
+        repair_item_counts(conn)
+    engine.dispose()
+    return (['category %d' % n for n in range(categories)],
+            [('category %d' % (n % categories), 'item %d' % n)
+             for n in range(items)])
+
+
+# ======================
+# Request plans
+# ======================
+
+def readRequests(rng, categories, items):
+    """Yield (route, method, path, form) for one pass over the read routes"""
+    category = quote(rng.choice(categories))
+    item_category, item = [quote(n) for n in rng.choice(items)]
+    word = rng.choice(WORDS)
+    yield 'showCatalog', 'GET', '/catalog/', None
+    yield 'showCategory', 'GET', '/catalog/%s/' % category, None
+    yield 'showItem', 'GET', '/catalog/%s/items/%s/' % (
+        item_category, item), None
+    yield 'showAllItems', 'GET', '/catalog/items', None
+    yield 'showItemsFragment', 'GET', '/catalog/items/fragment', None
+    yield 'showSearch', 'GET', '/catalog/search?q=%s' % word, None
+    yield 'searchJSON', 'GET', '/catalog/search/JSON?q=%s' % word, None
+    yield 'showLogin', 'GET', '/login', None
+    yield 'allJSON', 'GET', '/catalog/JSON', None
+    yield 'allJSONStream', 'GET', '/catalog/JSON/stream', None
+    yield 'categoriesJSON', 'GET', '/catalog/categories/JSON', None
+    yield 'categoriesJSON (page)', 'GET', \
+        '/catalog/categories/JSON?limit=100', None
+    yield 'categoryItemsJSON', 'GET', '/catalog/%s/items/JSON' % category, \
+        None
+    yield 'itemJSON', 'GET', '/catalog/%s/items/%s/JSON' % (
+        item_category, item), None
+    yield 'showMetrics', 'GET', '/metrics', None
+
+
+def writeRequests(n):
+    """Yield (route, method, path, form) creating, editing and deleting a
+    category and an item named after iteration n"""
+    category = 'bench category %s' % n
+    renamed = 'bench category %s renamed' % n
+    item = 'bench item %s' % n
+    c, r, i = quote(category), quote(renamed), quote(item)
+    yield 'addCategory', 'GET', '/catalog/addcategory', None
+    yield 'addCategory', 'POST', '/catalog/addcategory', {'name': category}
+    yield 'addItem', 'GET', '/catalog/add', None
+    yield 'addItem', 'POST', '/catalog/add', {
+        'name': item, 'description': 'benchmark item',
+        'picture': 'https://example.com/bench.png', 'category': category}
+    yield 'editItem', 'GET', '/catalog/%s/items/%s/edit' % (c, i), None
+    yield 'editItem', 'POST', '/catalog/%s/items/%s/edit' % (c, i), {
+        'name': '', 'description': 'edited', 'picture': '', 'category': ''}
+    yield 'editCategory', 'GET', '/catalog/%s/edit' % c, None
+    yield 'editCategory', 'POST', '/catalog/%s/edit' % c, {'name': renamed}
+    yield 'deleteItem', 'GET', '/catalog/%s/items/%s/delete' % (r, i), None
+    yield 'deleteItem', 'POST', '/catalog/%s/items/%s/delete' % (r, i), {}
+    yield 'deleteCategory', 'GET', '/catalog/%s/delete' % r, None
+    yield 'deleteCategory', 'POST', '/catalog/%s/delete' % r, {}
+
+
+def loginSession(client):
+    with client.session_transaction() as s:
+        s['username'] = 'user 0'
+        s['email'] = 'user0@example.com'
+        s['picture'] = ''
+        s['user_id'] = 1
+
+
+# ======================
+# Drivers
+# ======================
+
+class Recorder(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timings = {}
+        self.errors = {}
+
+    def record(self, route, method, seconds, status):
+        key = '%s %s' % (method, route)
+        with self.lock:
+            self.timings.setdefault(key, []).append(seconds)
+            if status >= 400:
+                self.errors[key] = self.errors.get(key, 0) + 1
+
+
+def runClient(app, plans, concurrency):
+    recorder = Recorder()
+
+    def worker(plan):
+        client = app.test_client()
+        loginSession(client)
+        for route, method, path, form in plan:
+            start = time.perf_counter()
+            response = client.open(path, method=method, data=form)
+            response.get_data()
+            recorder.record(route, method, time.perf_counter() - start,
+                            response.status_code)
+
+    runThreads(worker, plans, concurrency)
+    return recorder
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+def runServer(app, plans, concurrency):
+    recorder = Recorder()
+    server = make_server('127.0.0.1', 0, app, server_class=ThreadingServer,
+                         handler_class=QuietHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    port = server.server_address[1]
+
+    def worker(plan):
+        # Log in through the test client and reuse its session cookie
+        client = app.test_client()
+        loginSession(client)
+        cookie = client.get_cookie(app.config['SESSION_COOKIE_NAME'])
+        headers = {'Cookie': '%s=%s' % (cookie.key, cookie.value)}
+        for route, method, path, form in plan:
+            body = None
+            request_headers = dict(headers)
+            if form is not None and method == 'POST':
+                body = urlencode(form)
+                request_headers['Content-Type'] = \
+                    'application/x-www-form-urlencoded'
+            start = time.perf_counter()
+            conn = http.client.HTTPConnection('127.0.0.1', port)
+            conn.request(method, path, body=body, headers=request_headers)
+            response = conn.getresponse()
+            response.read()
+            conn.close()
+            recorder.record(route, method, time.perf_counter() - start,
+                            response.status)
+
+    try:
+        runThreads(worker, plans, concurrency)
+    finally:
+        server.shutdown()
+        server.server_close()
+    return recorder
+
+
+def runThreads(worker, plans, concurrency):
+    chunks = [plans[n::concurrency] for n in range(concurrency)]
+    threads = [threading.Thread(target=worker,
+                                args=([r for plan in chunk for r in plan],))
+               for chunk in chunks]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+
+# ======================
+# Reporting
+# ======================
+
+def percentile(values, p):
+    values = sorted(values)
+    index = min(int(round(p / 100.0 * (len(values) - 1))), len(values) - 1)
+    return values[index]
+
+
+def summarize(recorder):
+    results = {}
+    for key, timings in sorted(recorder.timings.items()):
+        results[key] = {
+            'count': len(timings),
+            'errors': recorder.errors.get(key, 0),
+            'p50': percentile(timings, 50) * 1000,
+            'p95': percentile(timings, 95) * 1000,
+            'p99': percentile(timings, 99) * 1000,
+            'rps': len(timings) / sum(timings),
+        }
+    return results
+
+
+def printResults(mode, results, elapsed, total):
+    print('\n%s: %d requests in %.1fs (%.0f requests/sec)'
+          % (mode, total, elapsed, total / elapsed))
+    print('%-34s %7s %7s %9s %9s %9s %9s' % (
+        'route', 'count', 'errors', 'p50 ms', 'p95 ms', 'p99 ms', 'req/s'))
+    for key, r in results.items():
+        print('%-34s %7d %7d %9.2f %9.2f %9.2f %9.0f' % (
+            key, r['count'], r['errors'], r['p50'], r['p95'], r['p99'],
+            r['rps']))
+
+
+def compare(report, baseline, tolerance):
+    """Print routes whose p95 regressed by more than tolerance, return
+    whether any did"""
+    regressed = False
+    for mode, results in report['modes'].items():
+        for key, r in results.items():
+            base = baseline.get('modes', {}).get(mode, {}).get(key)
+            if base and r['p95'] > base['p95'] * (1 + tolerance):
+                regressed = True
+                print('REGRESSION %s %s: p95 %.2fms, baseline %.2fms'
+                      % (mode, key, r['p95'], base['p95']))
+    base_rss = baseline.get('peak_rss_kb')
+    if base_rss and report['peak_rss_kb'] > base_rss * (1 + tolerance):
+        regressed = True
+        print('REGRESSION peak RSS %dKB, baseline %dKB'
+              % (report['peak_rss_kb'], base_rss))
+    return regressed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Load test the catalog routes')
+    parser.add_argument('--size', choices=sorted(SIZES), default='small',
+                        help='synthetic catalog size (1k, 100k, 1M items)')
+    parser.add_argument('--items', type=int,
+                        help='number of items, overrides --size')
+    parser.add_argument('--mode', choices=('client', 'server', 'both'),
+                        default='both')
+    parser.add_argument('--requests', type=int, default=20,
+                        help='passes over the read and write routes')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--save-baseline', metavar='FILE')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='exit with status 1 if p95 latency or peak RSS '
+                             'regressed against this baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='catalog-bench-')
+    url = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    os.environ['DATABASE_URL'] = url
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        shutil.copy(os.path.join(ROOT, 'client_secrets_fake.json'),
+                    'client_secrets.json')
+        items = args.items or SIZES[args.size]
+        start = time.perf_counter()
+        categories, item_names = generate(url, items)
+        print('generated %d items, %d categories in %.1fs'
+              % (items, len(categories), time.perf_counter() - start))
+
+        from app import create_app
+        app = create_app({'SECRET_KEY': 'benchmark'})
+
+        rng = random.Random(1)
+        report = {'items': items, 'modes': {}}
+        modes = ['client', 'server'] if args.mode == 'both' else [args.mode]
+        for mode in modes:
+            run = runClient if mode == 'client' else runServer
+            plans = [list(readRequests(rng, categories, item_names)) +
+                     list(writeRequests('%s %d' % (mode, n)))
+                     for n in range(args.requests)]
+            start = time.perf_counter()
+            recorder = run(app, plans, args.concurrency)
+            elapsed = time.perf_counter() - start
+            results = summarize(recorder)
+            report['modes'][mode] = results
+            printResults(mode, results, elapsed,
+                         sum(len(p) for p in plans))
+
+        report['peak_rss_kb'] = resource.getrusage(
+            resource.RUSAGE_SELF).ru_maxrss
+        print('\npeak RSS %d KB' % report['peak_rss_kb'])
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(report, json.load(f), args.tolerance):
+                return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3.7
+# Compare FTS5 item search with a LIKE scan
+#
+# Usage: python benchmarks/search.py [items] [queries]
+import os
+import sys
+import time
+import random
+import datetime
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import text
+from database_setup import Base, Category, Items, get_engine, setup_search
+
+WORDS = ('linear recurrent convolutional gated unit layer network attention '
+         'residual dense sparse batch norm dropout pooling kernel stride '
+         'embedding encoder decoder transformer memory cell hidden state '
+         'activation softmax relu sigmoid tanh gradient loss optimizer').split()
+# Each description also gets two rare terms, so both cheap (many early
+# matches) and expensive (few matches, LIKE scans the table) queries are timed
+RARE_WORDS = 100000
+
+FTS_QUERY = text('''
+    SELECT item.id, snippet(item_search, -1, '[', ']', '...', 12)
+    FROM item_search JOIN item ON item.id = item_search.rowid
+    WHERE item_search MATCH :query ORDER BY rank LIMIT 20''')
+LIKE_QUERY = text('''
+    SELECT id, description FROM item
+    WHERE name LIKE :pattern OR description LIKE :pattern
+    ORDER BY name LIMIT 20''')
+
+
+def build(path, size):
+    engine = get_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+    setup_search(engine)
+    rng = random.Random(0)
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        conn.execute(Category.__table__.insert(), [
+            {'name': 'category %d' % n, 'user_id': 1} for n in range(100)])
+        for start in range(0, size, 50000):
+            conn.execute(Items.__table__.insert(), [
+                {'name': '%s %d' % (' '.join(rng.sample(WORDS, 2)), n),
+                 'description': ' '.join(
+                    [rng.choice(WORDS) for w in range(18)] +
+                    ['rare%05dx' % rng.randrange(RARE_WORDS)
+                     for w in range(2)]),
+                 'date': now, 'user_id': 1, 'category_id': n % 100 + 1}
+                for n in range(start, min(start + 50000, size))])
+    return engine
+
+
+def timeQueries(engine, statement, params):
+    with engine.connect() as conn:
+        start = time.perf_counter()
+        for p in params:
+            conn.execute(statement, p).fetchall()
+        return (time.perf_counter() - start) / len(params) * 1000
+
+
+def main(size=1000000, queries=20):
+    path = tempfile.mktemp(suffix='.db')
+    try:
+        start = time.perf_counter()
+        engine = build(path, size)
+        print('built %d items in %.1fs' % (size, time.perf_counter() - start))
+        rng = random.Random(1)
+        print('%-8s %14s %14s' % ('terms', 'fts5 (ms)', 'like (ms)'))
+        for label, terms in (
+                ('common', [rng.choice(WORDS) for n in range(queries)]),
+                ('rare', ['rare%05dx' % rng.randrange(RARE_WORDS)
+                          for n in range(queries)])):
+            fts = timeQueries(engine, FTS_QUERY, [
+                {'query': t} for t in terms])
+            like = timeQueries(engine, LIKE_QUERY, [
+                {'pattern': '%%%s%%' % t} for t in terms])
+            print('%-8s %14.2f %14.2f' % (label, fts, like))
+    finally:
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3.7
+# Exercise /media/thumb against a local stand-in for the picture hosts
+#
+# Usage: python benchmarks/thumbnail_proxy.py [items] [concurrency] [delay ms]
+#
+# Item pictures point at a local HTTP server that serves a generated PNG
+# after `delay` milliseconds. Every thumbnail is requested by `concurrency`
+# threads at once, first with a cold cache and then a warm one, and then
+# revalidated with If-None-Match. Checks that each picture was downloaded
+# exactly once and that revalidation answers 304.
+import os
+import shutil
+import struct
+import sys
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import String, cast
+from routes import generate
+
+
+def png(width, height):
+    """An RGB gradient as PNG bytes"""
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data +
+                struct.pack('>I', zlib.crc32(kind + data)))
+    rows = b''.join(
+        b'\x00' + bytes(value for x in range(width)
+                        for value in (x * 255 // width, y * 255 // height,
+                                      128))
+        for y in range(height))
+    return (b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0,
+                                       0, 0)) +
+            chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b''))
+
+
+class PictureHost(object):
+    """Serves the same PNG at every path and counts requests"""
+
+    def __init__(self, delay):
+        image = png(1024, 768)
+        self.requests = 0
+        lock = threading.Lock()
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                with lock:
+                    host.requests += 1
+                time.sleep(delay)
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(image)))
+                self.end_headers()
+                self.wfile.write(image)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+
+
+def run(client, item_ids, concurrency, headers=None):
+    """Request every thumbnail from `concurrency` threads at once, return
+    (seconds, {status: count})"""
+    def get(item_id):
+        response = client.get('/media/thumb/%d' % item_id,
+                              headers=headers(item_id) if headers else None)
+        response.close()
+        return response.status_code
+
+    statuses = {}
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        requests = [item_id for item_id in item_ids
+                    for n in range(concurrency)]
+        for status in pool.map(get, requests):
+            statuses[status] = statuses.get(status, 0) + 1
+    return time.perf_counter() - start, statuses
+
+
+def main(items=200, concurrency=8, delay=50):
+    host = PictureHost(delay / 1000.0)
+    workdir = tempfile.mkdtemp(prefix='catalog-thumbnails-')
+    url = 'sqlite:///' + os.path.join(workdir, 'bench.db')
+    generate(url, items)
+
+    try:
+        import app
+        flask_app = app.create_app({
+            'DATABASE_URL': url, 'SECRET_KEY': 'benchmark',
+            'THUMBNAIL_DIR': os.path.join(workdir, 'thumbnails'),
+            'JOB_OUTBOX': os.path.join(workdir, 'outbox.db'),
+            'SESSION_STORE': 'memory', 'THUMBNAIL_ALLOW_PRIVATE': True})
+        with app.engine.begin() as conn:
+            conn.execute(app.item_table.update().values(
+                picture=host.url + '/' +
+                cast(app.item_table.c.id, String) + '.png'))
+        client = flask_app.test_client()
+        item_ids = range(1, items + 1)
+
+        print('%d items, %d concurrent requests each, %d ms origin delay'
+              % (items, concurrency, delay))
+        seconds, statuses = run(client, item_ids, concurrency)
+        print('cold   %8.2fs %10.0f req/s %s' % (
+            seconds, items * concurrency / seconds, statuses))
+        seconds, statuses = run(client, item_ids, concurrency)
+        print('warm   %8.2fs %10.0f req/s %s' % (
+            seconds, items * concurrency / seconds, statuses))
+        etags = dict((item_id, client.get('/media/thumb/%d' % item_id)
+                      .headers['ETag']) for item_id in item_ids)
+        seconds, statuses = run(client, item_ids, concurrency,
+                                lambda item_id: {'If-None-Match':
+                                                 etags[item_id]})
+        print('304s   %8.2fs %10.0f req/s %s' % (
+            seconds, items * concurrency / seconds, statuses))
+
+        stats = app.thumbnailer.stats
+        print('origin requests %d, collapsed %d, cache %d files %.1f MB'
+              % (host.requests, stats['collapsed'], stats['files'],
+                 stats['bytes'] / 1048576.0))
+        if host.requests != items or statuses != {304: items * concurrency}:
+            print('every picture should be downloaded once and revalidated!')
+            raise SystemExit(1)
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,273 @@
+# In-process and response caching helpers
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Response, make_response, request
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class TTLCache(object):
+    """Thread safe LRU cache whose entries expire after `ttl` seconds,
+    or only on eviction when ttl is None"""
+
+    def __init__(self, ttl=30, maxsize=128):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def lookup(self, key):
+        """Return (True, value) for a live entry, otherwise (False, None)"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None and entry[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.hits += 1
+                return True, entry[1]
+            self.misses += 1
+            return False, None
+
+    def set(self, key, value, ttl=None):
+        """Store value, ttl overrides the cache's TTL for this entry"""
+        ttl = self.ttl if ttl is None else ttl
+        with self._lock:
+            if ttl is None:
+                expires = float('inf')
+            else:
+                expires = time.monotonic() + ttl
+            self._data[key] = (expires, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get(self, key, load):
+        """Return the cached value for key, calling load() on a miss"""
+        found, value = self.lookup(key)
+        if not found:
+            value = load()
+            self.set(key, value)
+        return value
+
+    def invalidate(self, key=None):
+        """Drop one key, or every entry when no key is given"""
+        with self._lock:
+            if key is None:
+                self._data.clear()
+            else:
+                self._data.pop(key, None)
+
+    def expire(self):
+        """Drop expired entries, return how many were removed"""
+        now = time.monotonic()
+        with self._lock:
+            expired = [k for k, (expires, v) in self._data.items()
+                       if expires <= now]
+            for key in expired:
+                del self._data[key]
+        return len(expired)
+
+    def __len__(self):
+        return len(self._data)
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'size': len(self._data),
+                    'maxsize': self.maxsize,
+                    'ttl': self.ttl}
+
+
+# ======================
+# Response cache
+# ======================
+
+class VersionFile(object):
+    """A catalog version counter kept in a file, so that every worker
+    process sharing it sees the same version. Bumps are serialized by a
+    lock, and by an flock on a .lock file next to it between processes"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+
+    def get(self):
+        try:
+            with open(self.path) as f:
+                return int(f.read() or 0)
+        except (IOError, ValueError):
+            return 0
+
+    def changed_at(self):
+        """When the version was last bumped, 0 if it never was"""
+        try:
+            return os.path.getmtime(self.path)
+        except OSError:
+            return 0.0
+
+    def bump(self):
+        with self._lock, open(self.path + '.lock', 'a') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            version = self.get() + 1
+            write_file(self.path, str(version).encode())
+            return version
+
+
+def write_file(filename, data):
+    """Replace filename with data atomically"""
+    tmp = '%s.%d.%d.tmp' % (filename, os.getpid(), threading.get_ident())
+    with open(tmp, 'wb') as f:
+        f.write(data)
+    os.replace(tmp, filename)
+
+
+class MemoryBackend(object):
+    """Keeps cached responses in a per-process LRU for at most `ttl`
+    seconds. With a version_file the catalog version is shared between
+    processes, so a write in one worker invalidates the others"""
+
+    def __init__(self, maxsize=1024, ttl=30, version_file=None):
+        self.version = 0
+        self.version_file = VersionFile(version_file) if version_file \
+            else None
+        self._entries = TTLCache(ttl=ttl, maxsize=maxsize)
+
+    def get_version(self):
+        if self.version_file is not None:
+            return self.version_file.get()
+        return self.version
+
+    def bump_version(self):
+        if self.version_file is not None:
+            self.version_file.bump()
+        else:
+            self.version += 1
+        self._entries.invalidate()
+
+    def changed_at(self):
+        """When the shared version was last bumped, 0 if there is none"""
+        if self.version_file is not None:
+            return self.version_file.changed_at()
+        return 0.0
+
+    def prune(self):
+        self._entries.expire()
+
+    def load(self, key):
+        return self._entries.lookup(key)[1]
+
+    def store(self, key, entry):
+        self._entries.set(key, entry)
+
+    @property
+    def stats(self):
+        return self._entries.stats
+
+
+class FileBackend(object):
+    """Keeps cached responses and the catalog version in a directory so
+    that every worker process sharing it sees the same cache"""
+
+    def __init__(self, path):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(path, exist_ok=True)
+        self._version = VersionFile(os.path.join(path, 'VERSION'))
+
+    def get_version(self):
+        return self._version.get()
+
+    def bump_version(self):
+        self._version.bump()
+
+    def changed_at(self):
+        return self._version.changed_at()
+
+    def prune(self):
+        """Remove entries of older versions. They are never read again, so
+        this only keeps the directory bounded and can run in the background"""
+        current = '%d-' % self.get_version()
+        for name in os.listdir(self.path):
+            if name.endswith('.cache') and not name.startswith(current):
+                try:
+                    os.remove(os.path.join(self.path, name))
+                except OSError:
+                    pass
+
+    def _file(self, key):
+        version, path = key.split(':', 1)
+        digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, '%s-%s.cache' % (version, digest))
+
+    def load(self, key):
+        try:
+            with open(self._file(key), 'rb') as f:
+                header, body = f.read().split(b'\n', 1)
+        except (IOError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        etag, mimetype = json.loads(header.decode('utf-8'))
+        return etag, mimetype, body
+
+    def store(self, key, entry):
+        etag, mimetype, body = entry
+        header = json.dumps([etag, mimetype]).encode('utf-8')
+        write_file(self._file(key), header + b'\n' + body)
+
+    @property
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'path': self.path}
+
+
+class ResponseCache(object):
+    """Caches GET responses by catalog version and URL, serving strong
+    ETags and answering If-None-Match with 304 Not Modified. The weak form
+    of an ETag matches too, compressed responses carry weak ETags"""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def bump_version(self):
+        self.backend.bump_version()
+
+    def cached(self, f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            key = '%s:%s' % (self.backend.get_version(),
+                             request.full_path)
+            entry = self.backend.load(key)
+            if entry is None:
+                response = make_response(f(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                body = response.get_data()
+                etag = hashlib.sha1(body).hexdigest()
+                entry = (etag, response.mimetype, body)
+                self.backend.store(key, entry)
+
+            etag, mimetype, body = entry
+            if request.if_none_match.contains_weak(etag):
+                response = Response(status=304)
+            else:
+                response = Response(body, mimetype=mimetype)
+            response.set_etag(etag)
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
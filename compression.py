@@ -0,0 +1,137 @@
+# Negotiated gzip and brotli compression of responses
+#
+# Bodies of compressible types above `min_size` bytes are compressed with
+# the best encoding the client accepts. Streamed responses, like the NDJSON
+# export, are compressed chunk by chunk and flushed after each chunk, so a
+# client can decode every chunk as soon as it arrives. brotli is used
+# when the optional brotli package is installed.
+import zlib
+
+from flask import request
+
+from cache import TTLCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_TYPES = ('text/html', 'text/css', 'text/plain',
+                      'text/javascript', 'application/javascript',
+                      'application/json', 'application/x-ndjson',
+                      'image/svg+xml')
+
+
+def encodings():
+    """Supported encodings, most preferred first"""
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def negotiate():
+    """The encoding to use for the current request, or None"""
+    return request.accept_encodings.best_match(encodings())
+
+
+class GzipStream(object):
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        return self._compressor.compress(data)
+
+    def sync(self):
+        return self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def flush(self):
+        return self._compressor.flush()
+
+
+class BrotliStream(object):
+    def __init__(self, quality):
+        self._compressor = brotli.Compressor(quality=quality)
+
+    def compress(self, data):
+        return self._compressor.process(data)
+
+    def sync(self):
+        return self._compressor.flush()
+
+    def flush(self):
+        return self._compressor.finish()
+
+
+class Compressor(object):
+    """Compresses the responses of a Flask app. Compressed copies of
+    responses with a strong ETag are kept in a small LRU, so cached JSON
+    documents are only compressed once per version"""
+
+    def __init__(self, min_size=1024, level=6, brotli_quality=5,
+                 cache_size=32):
+        self.min_size = min_size
+        self.level = level
+        self.brotli_quality = brotli_quality
+        self.cache = TTLCache(ttl=None, maxsize=cache_size)
+
+    def init_app(self, app):
+        app.after_request(self.after_request)
+
+    def stream(self, encoding):
+        if encoding == 'br':
+            return BrotliStream(self.brotli_quality)
+        return GzipStream(self.level)
+
+    def compress(self, data, encoding):
+        stream = self.stream(encoding)
+        return stream.compress(data) + stream.flush()
+
+    def after_request(self, response):
+        if response.status_code == 304:
+            # Keep the ETag the client holds for a compressed copy weak
+            etag, weak = response.get_etag()
+            if etag and not weak and request.if_none_match.is_weak(etag):
+                response.set_etag(etag, weak=True)
+                response.vary.add('Accept-Encoding')
+            return response
+        if response.status_code < 200 or response.status_code == 204 \
+                or response.direct_passthrough \
+                or 'Content-Encoding' in response.headers \
+                or response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+        if not response.is_streamed and \
+                response.content_length is not None and \
+                response.content_length < self.min_size:
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = negotiate()
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = self.compress_stream(response.response,
+                                                     encoding)
+            response.headers.pop('Content-Length', None)
+        else:
+            etag, weak = response.get_etag()
+            key = (etag, encoding)
+            found, data = self.cache.lookup(key) if etag and not weak \
+                else (False, None)
+            if not found:
+                data = self.compress(response.get_data(), encoding)
+                if etag and not weak:
+                    self.cache.set(key, data)
+            response.set_data(data)
+        response.headers['Content-Encoding'] = encoding
+        # The compressed body differs from the identity one byte for byte
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
+
+    def compress_stream(self, chunks, encoding):
+        stream = self.stream(encoding)
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode('utf-8')
+            yield stream.compress(chunk) + stream.sync()
+        yield stream.flush()
@@ -1,44 +1,275 @@
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
-from database_setup import *
+#!/usr/bin/env python3.7
+# Populate the database from a JSON or newline delimited JSON dump
+#
+# JSON input uses the data.json layout of "Users", "Categories" and "Items"
+# lists. NDJSON input has one record per line with a "type" of "user",
+# "category" or "item". Both are read as a stream and inserted in batches.
+import argparse
 import datetime
 import json
+import sys
+import time
+from sqlalchemy.orm import sessionmaker
+from database_setup import *
 
-engine = create_engine('sqlite:///item_database.db')
-Base.metadata.bind = engine
+# Models in insert order, with the keys used to match existing rows on upsert
+MODELS = [
+    ('user', 'Users', User, ('email',)),
+    ('category', 'Categories', Category, ('name',)),
+    ('item', 'Items', Items, ('category_id', 'name')),
+]
+MODEL_TYPES = dict((m[0], m) for m in MODELS)
+MODEL_SECTIONS = dict((m[1], m) for m in MODELS)
 
-DBSession = sessionmaker(bind=engine)
-session = DBSession()
+READ_SIZE = 64 * 1024
 
-# Delete existing database contents for fresh start
-session.query(Category).delete()
-session.query(Items).delete()
-session.query(User).delete()
 
-file = open('data.json', 'r').read()
-j = json.loads(file)
+# ======================
+# Input readers
+# ======================
 
-for new_user in j['Users']:
-    New_User = User(name=new_user['name'],
-                    email=new_user['email'],
-                    picture=new_user['picture'])
-    session.add(New_User)
-    session.commit()
+def read_ndjson(f):
+    """Yield (type, record) for each line of an NDJSON file"""
+    for number, line in enumerate(f, 1):
+        line = line.strip()
+        if not line:
+            continue
+        record = json.loads(line)
+        kind = record.pop('type', None)
+        if kind not in MODEL_TYPES:
+            raise ValueError('line %d: unknown record type %r'
+                             % (number, kind))
+        yield kind, record
 
-for cat in j['Categories']:
-    New_Category = Category(name=cat['name'],
-                            user_id=cat['user_id'])
-    session.add(New_Category)
-    session.commit()
 
-for item in j['Items']:
-    New_Item = Items(name=item['name'],
-                     date=datetime.datetime.now(),
-                     picture=item['picture'],
-                     description=item['description'],
-                     category_id=item['category_id'],
-                     user_id=item['user_id'])
-    session.add(New_Item)
+def read_json(f):
+    """Yield (type, record) for each element of the top level lists in a
+    JSON file, without loading the whole document into memory"""
+    decoder = json.JSONDecoder()
+    buf = ''
+    pos = 0
+    eof = False
+
+    def fill():
+        # Read more input, returns False at the end of the file
+        nonlocal buf, pos, eof
+        chunk = f.read(READ_SIZE)
+        buf = buf[pos:] + chunk
+        pos = 0
+        eof = not chunk
+        return bool(chunk)
+
+    def skip_ws():
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in ' \t\r\n':
+                pos += 1
+            if pos < len(buf) or not fill():
+                return
+
+    def expect(chars):
+        nonlocal pos
+        skip_ws()
+        if pos >= len(buf) or buf[pos] not in chars:
+            raise ValueError('expected one of %r in JSON input' % chars)
+        pos += 1
+        return buf[pos - 1]
+
+    def decode():
+        nonlocal pos
+        while True:
+            skip_ws()
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof or not fill():
+                    raise
+                continue
+            # A value ending at the buffer edge may be truncated (numbers)
+            if end == len(buf) and not eof and fill():
+                continue
+            pos = end
+            return value
+
+    expect('{')
+    skip_ws()
+    if buf[pos:pos + 1] == '}':
+        return
+    while True:
+        section = decode()
+        expect(':')
+        if section not in MODEL_SECTIONS:
+            decode()
+        else:
+            kind = MODEL_SECTIONS[section][0]
+            expect('[')
+            skip_ws()
+            if buf[pos:pos + 1] == ']':
+                pos += 1
+            else:
+                while True:
+                    yield kind, decode()
+                    if expect(',]') == ']':
+                        break
+        if expect(',}') == '}':
+            return
+
+
+# ======================
+# Loader
+# ======================
+
+class BulkLoader(object):
+    """Inserts records in batches, committing once per batch"""
+
+    def __init__(self, session, batch_size=5000, upsert=False,
+                 progress=True):
+        self.session = session
+        self.batch_size = batch_size
+        self.upsert = upsert
+        self.progress = progress
+        self.buffers = dict((m[0], []) for m in MODELS)
+        self.counts = dict((m[0], 0) for m in MODELS)
+        self.start = time.monotonic()
+
+    @property
+    def total(self):
+        return sum(self.counts.values())
+
+    def add(self, kind, record):
+        self.buffers[kind].append(self.mapping(kind, record))
+        if len(self.buffers[kind]) >= self.batch_size:
+            self.flush(kind)
+
+    def mapping(self, kind, record):
+        model = MODEL_TYPES[kind][2]
+        row = dict((c.key, record[c.key]) for c in model.__table__.columns
+                   if c.key in record)
+        if model is Items:
+            date = row.get('date')
+            if date:
+                row['date'] = datetime.datetime.fromisoformat(date)
+            else:
+                row['date'] = datetime.datetime.now()
+        return row
+
+    def flush(self, kind=None):
+        """Write buffered rows of kind, and of every model it depends on"""
+        for name, section, model, keys in MODELS:
+            rows = self.buffers[name]
+            if rows:
+                if self.upsert:
+                    self.write_upsert(model, keys, rows)
+                else:
+                    self.session.bulk_insert_mappings(model, rows)
+                self.session.commit()
+                self.counts[name] += len(rows)
+                self.buffers[name] = []
+                self.report()
+            if name == kind:
+                break
+
+    def write_upsert(self, model, keys, rows):
+        # Look up the whole batch's natural keys in one query, then update
+        # the rows that exist and insert the rest
+        columns = [getattr(model, k) for k in keys]
+        existing = {}
+        values = set(tuple(row.get(k) for k in keys) for row in rows)
+        if len(keys) == 1:
+            matches = self.session.query(model.id, *columns).filter(
+                columns[0].in_([v[0] for v in values]))
+        else:
+            matches = self.session.query(model.id, *columns).filter(
+                columns[0].in_(set(v[0] for v in values)),
+                columns[1].in_(set(v[1] for v in values)))
+        for match in matches:
+            existing[tuple(match[1:])] = match[0]
+        ids = [row['id'] for row in rows if 'id' in row]
+        existing_ids = set(i for i, in self.session.query(model.id).filter(
+            model.id.in_(ids))) if ids else set()
+
+        inserts, updates = [], []
+        for row in rows:
+            key = tuple(row.get(k) for k in keys)
+            if key in existing:
+                row['id'] = existing[key]
+                updates.append(row)
+            elif row.get('id') in existing_ids:
+                updates.append(row)
+            else:
+                inserts.append(row)
+        if updates:
+            self.session.bulk_update_mappings(model, updates)
+        if inserts:
+            self.session.bulk_insert_mappings(model, inserts)
+
+    def report(self):
+        if not self.progress:
+            return
+        elapsed = time.monotonic() - self.start
+        print('%s rows loaded (%s) %.0f rows/sec' % (
+            self.total,
+            ', '.join('%s %d' % (m[1].lower(), self.counts[m[0]])
+                      for m in MODELS),
+            self.total / elapsed if elapsed else 0), file=sys.stderr)
+
+    def load(self, records):
+        for kind, record in records:
+            self.add(kind, record)
+        self.flush()
+        # Bulk writes skip the ORM events that maintain item counts
+        repair_item_counts(self.session.connection())
+        self.session.commit()
+        return self.counts
+
+
+def clear_database(session):
+    """Delete existing database contents for fresh start"""
+    session.query(Category).delete()
+    session.query(Items).delete()
+    session.query(User).delete()
     session.commit()
 
-print("Database Population Complete")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Populate the database from a JSON or NDJSON dump')
+    parser.add_argument('path', nargs='?', default='data.json',
+                        help='input file, - for stdin (default data.json)')
+    parser.add_argument('--format', choices=('json', 'ndjson'),
+                        help='input format, guessed from the file extension '
+                             'by default')
+    parser.add_argument('--batch-size', type=int, default=5000,
+                        help='rows per insert batch and transaction')
+    parser.add_argument('--upsert', action='store_true',
+                        help='update matching rows instead of deleting '
+                             'existing contents first')
+    parser.add_argument('--quiet', action='store_true',
+                        help='do not report progress')
+    args = parser.parse_args(argv)
+
+    fmt = args.format
+    if fmt is None:
+        fmt = 'ndjson' if args.path.endswith(('.ndjson', '.jsonl')) \
+            else 'json'
+    reader = read_ndjson if fmt == 'ndjson' else read_json
+
+    engine = get_engine()
+    init_database(engine)
+    session = sessionmaker(bind=engine)()
+    if not args.upsert:
+        clear_database(session)
+
+    loader = BulkLoader(session, batch_size=args.batch_size,
+                        upsert=args.upsert, progress=not args.quiet)
+    if args.path == '-':
+        loader.load(reader(sys.stdin))
+    else:
+        with open(args.path, 'r') as f:
+            loader.load(reader(f))
+
+    print("Database Population Complete")
+
+
+if __name__ == '__main__':
+    main()
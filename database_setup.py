@@ -1,9 +1,27 @@
 #!/usr/bin/env python3.7
 # Database setup script
-from sqlalchemy import Column, ForeignKey, Integer, String, DateTime
+import argparse
+import logging
+import os
+from contextlib import contextmanager
+from sqlalchemy import (Column, ForeignKey, Integer, String, DateTime, Float,
+                        Index)
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship, backref
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text, func, select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+
+# Engine configuration, overridable through the environment
+DATABASE_URL = os.environ.get('DATABASE_URL', 'sqlite:///item_database.db')
+POOL_SIZE = int(os.environ.get('DATABASE_POOL_SIZE', 5))
+MAX_OVERFLOW = int(os.environ.get('DATABASE_MAX_OVERFLOW', 10))
+SQLITE_WAL = os.environ.get('SQLITE_WAL', '1') != '0'
+SQLITE_BUSY_TIMEOUT = int(os.environ.get('SQLITE_BUSY_TIMEOUT', 5000))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+log = logging.getLogger(__name__)
 
 Base = declarative_base()
 
@@ -14,7 +32,7 @@ class User(Base):
 
     id = Column(Integer, primary_key=True)
     name = Column(String(250), nullable=False)
-    email = Column(String(250), nullable=False)
+    email = Column(String(250), nullable=False, index=True, unique=True)
     picture = Column(String(250))
 
 
@@ -23,9 +41,12 @@ class Category(Base):
     __tablename__ = "category"
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(50), nullable=False)
+    name = Column(String(50), nullable=False, index=True, unique=True)
     user_id = Column(Integer, ForeignKey('user.id'))
     user = relationship(User)
+    # Denormalized number of items, maintained by the Items mapper events
+    item_count = Column(Integer, nullable=False, default=0,
+                        server_default='0')
 
     @property
     def serialize(self):
@@ -41,9 +62,12 @@ class Category(Base):
 class Items(Base):
     """Creates item information table"""
     __tablename__ = "item"
+    __table_args__ = (
+        Index('ix_item_category_id_name', 'category_id', 'name'),
+    )
 
     id = Column(Integer, primary_key=True)
-    name = Column(String(80), nullable=False)
+    name = Column(String(80), nullable=False, index=True)
     date = Column(DateTime, nullable=False)
     description = Column(String(500))
     picture = Column(String(250))
@@ -67,5 +91,284 @@ class Items(Base):
         }
 
 
-engine = create_engine('sqlite:///item_database.db')
-Base.metadata.create_all(engine)
+class Heartbeat(Base):
+    """A single row the primary updates every second while read replicas
+    are configured, to measure how far behind they are"""
+    __tablename__ = "replica_heartbeat"
+
+    id = Column(Integer, primary_key=True)
+    written_at = Column(Float, nullable=False)
+
+
+# Columns of Category.serialize and Items.serialize, for read paths that
+# select rows with Core instead of loading ORM objects
+CATEGORY_COLUMNS = [Category.__table__.c[name]
+                    for name in ('id', 'name', 'user_id')]
+ITEM_COLUMNS = [Items.__table__.c[name]
+                for name in ('id', 'name', 'description', 'user_id',
+                             'picture', 'category_id')]
+
+
+def serialize_rows(columns, rows):
+    """Dicts shaped like the serialize properties for rows of columns"""
+    keys = [c.name for c in columns]
+    return [dict(zip(keys, row)) for row in rows]
+
+
+# Keep Category.item_count in step with item inserts, deletes and moves.
+# The updates run on the flushing connection, so they commit or roll back
+# together with the item change. Bulk inserts bypass these events and
+# must be followed by repair_item_counts().
+def change_item_count(connection, category_id, delta):
+    if category_id is not None:
+        connection.execute(Category.__table__.update().where(
+            Category.id == category_id).values(
+            item_count=Category.item_count + delta))
+
+
+@event.listens_for(Items, 'after_insert')
+def item_inserted(mapper, connection, target):
+    change_item_count(connection, target.category_id, 1)
+
+
+@event.listens_for(Items, 'after_delete')
+def item_deleted(mapper, connection, target):
+    change_item_count(connection, target.category_id, -1)
+
+
+@event.listens_for(Items, 'before_update')
+def item_updated(mapper, connection, target):
+    # Items are usually moved by assigning the category relationship. The
+    # foreign key is synced during the flush, and if it was expired (after
+    # a commit) its old value was never loaded, so it is read back from
+    # the row before it is updated
+    history = inspect(target).attrs.category_id.history
+    if history.deleted:
+        old_category_id = history.deleted[0]
+    elif history.added:
+        old_category_id = connection.execute(select(Items.category_id).where(
+            Items.id == target.id)).scalar()
+    else:
+        return
+    if old_category_id != target.category_id:
+        change_item_count(connection, old_category_id, -1)
+        change_item_count(connection, target.category_id, 1)
+
+
+def item_count_mismatches(connection):
+    """Return (id, name, stored count, actual count) for every category
+    whose item_count is wrong"""
+    actual = select(func.count(Items.id)).where(
+        Items.category_id == Category.id).scalar_subquery()
+    return connection.execute(select(
+        Category.id, Category.name, Category.item_count,
+        actual.label('actual')).where(Category.item_count != actual)).all()
+
+
+def repair_item_counts(connection):
+    """Recount the items of every category"""
+    connection.execute(Category.__table__.update().values(
+        item_count=select(func.count(Items.id)).where(
+            Items.category_id == Category.id).scalar_subquery()))
+
+
+def duplicate_values(connection, columns):
+    """Return (values..., count) for every value of columns that occurs
+    more than once"""
+    count = func.count().label('count')
+    return connection.execute(select(*columns, count).group_by(
+        *columns).having(count > 1)).all()
+
+
+def duplicate_report(engine):
+    """Return (index, duplicate rows) for every unique index whose columns
+    hold duplicates"""
+    report = []
+    with engine.connect() as conn:
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.unique:
+                    duplicates = duplicate_values(conn, list(index.columns))
+                    if duplicates:
+                        report.append((index, duplicates))
+    return report
+
+
+def upgrade_database(engine):
+    """Add columns and indexes missing from a database created by an
+    older version. Unique indexes over columns that already hold duplicate
+    values are skipped with a warning, run this script with
+    --check-duplicates to list them"""
+    columns = [c['name'] for c in inspect(engine).get_columns('category')]
+    if 'item_count' not in columns:
+        with engine.begin() as conn:
+            conn.execute(text('ALTER TABLE category ADD COLUMN item_count '
+                              'INTEGER NOT NULL DEFAULT 0'))
+            repair_item_counts(conn)
+    duplicated = set(index for index, rows in duplicate_report(engine))
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index in duplicated:
+                log.warning('not creating unique index %s, %s has duplicate '
+                            'values. Run python database_setup.py '
+                            '--check-duplicates to list them', index.name,
+                            ', '.join(c.name for c in index.columns))
+                continue
+            index.create(bind=engine, checkfirst=True)
+
+
+def get_engine(url=None, pool_size=None, max_overflow=None, wal=None):
+    """Create an engine for url (DATABASE_URL by default). File based
+    SQLite databases get a connection pool and WAL mode pragmas so that
+    readers and writers in several workers don't block each other"""
+    url = make_url(url or DATABASE_URL)
+    pool_size = POOL_SIZE if pool_size is None else pool_size
+    max_overflow = MAX_OVERFLOW if max_overflow is None else max_overflow
+    wal = SQLITE_WAL if wal is None else wal
+
+    if url.get_backend_name() != 'sqlite':
+        return create_engine(url, pool_size=pool_size,
+                             max_overflow=max_overflow, pool_pre_ping=True)
+    if url.database in (None, '', ':memory:'):
+        return create_engine(url)
+
+    engine = create_engine(
+        url, poolclass=QueuePool, pool_size=pool_size,
+        max_overflow=max_overflow,
+        connect_args={'check_same_thread': False,
+                      'timeout': SQLITE_BUSY_TIMEOUT / 1000.0})
+
+    @event.listens_for(engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        if wal:
+            cursor.execute('PRAGMA journal_mode=WAL')
+            cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=%d' % SQLITE_BUSY_TIMEOUT)
+        cursor.execute('PRAGMA mmap_size=%d' % SQLITE_MMAP_SIZE)
+        cursor.close()
+
+    return engine
+
+
+# Full text index over item names and descriptions. It is an external
+# content FTS5 table kept in sync with `item` by triggers, so bulk loads
+# and raw SQL writes are indexed as well as ORM writes.
+SEARCH_TRIGGER_DDL = [
+    """CREATE TRIGGER item_search_insert AFTER INSERT ON item BEGIN
+        INSERT INTO item_search(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+    """CREATE TRIGGER item_search_delete AFTER DELETE ON item BEGIN
+        INSERT INTO item_search(item_search, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+    END""",
+    """CREATE TRIGGER item_search_update AFTER UPDATE ON item BEGIN
+        INSERT INTO item_search(item_search, rowid, name, description)
+        VALUES ('delete', old.id, old.name, old.description);
+        INSERT INTO item_search(rowid, name, description)
+        VALUES (new.id, new.name, new.description);
+    END""",
+]
+SEARCH_DDL = ["""CREATE VIRTUAL TABLE item_search USING fts5(
+    name, description, content='item', content_rowid='id')"""
+              ] + SEARCH_TRIGGER_DDL
+SEARCH_TRIGGERS = ('item_search_insert', 'item_search_delete',
+                   'item_search_update')
+
+
+def search_available(engine):
+    """True if the full text index exists, without creating it"""
+    if engine.dialect.name != 'sqlite':
+        return False
+    with engine.connect() as conn:
+        return conn.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'item_search'"
+        )).first() is not None
+
+
+def setup_search(engine):
+    """Create and populate the full text index if it is missing. Returns
+    False when the database doesn't support FTS5"""
+    if engine.dialect.name != 'sqlite':
+        return False
+    try:
+        with engine.begin() as conn:
+            exists = conn.execute(text(
+                "SELECT 1 FROM sqlite_master WHERE name = 'item_search'"
+            )).first()
+            if not exists:
+                for statement in SEARCH_DDL:
+                    conn.execute(text(statement))
+                conn.execute(text(
+                    "INSERT INTO item_search(item_search) VALUES ('rebuild')"))
+    except OperationalError:
+        return False
+    return True
+
+
+@contextmanager
+def search_index_suspended(connection):
+    """Drop the full text index triggers for the rest of the connection's
+    transaction, then recreate them and rebuild the index. Bulk loads run
+    several times faster than with the index updated row by row"""
+    if connection.dialect.name != 'sqlite' or not connection.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'item_search'")).first():
+        yield
+        return
+    for name in SEARCH_TRIGGERS:
+        connection.execute(text('DROP TRIGGER IF EXISTS %s' % name))
+    yield
+    for statement in SEARCH_TRIGGER_DDL:
+        connection.execute(text(statement))
+    connection.execute(text(
+        "INSERT INTO item_search(item_search) VALUES ('rebuild')"))
+
+
+def init_database(engine):
+    """Create missing tables, upgrade a database created by an older
+    version and set up the search index. Returns whether search is
+    available"""
+    Base.metadata.create_all(engine)
+    upgrade_database(engine)
+    return setup_search(engine)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Create or upgrade the catalog database')
+    parser.add_argument('--check-counts', action='store_true',
+                        help='report categories whose item count is wrong')
+    parser.add_argument('--repair-counts', action='store_true',
+                        help='recount the items of every category')
+    parser.add_argument('--check-duplicates', action='store_true',
+                        help='report values that prevent a unique index '
+                             'from being created')
+    args = parser.parse_args()
+    logging.basicConfig()
+    engine = get_engine()
+    init_database(engine)
+    if args.check_duplicates:
+        report = duplicate_report(engine)
+        for index, duplicates in report:
+            for row in duplicates:
+                print('%s: %r occurs %d times' % (
+                    index.name, tuple(row[:-1]), row[-1]))
+        if report:
+            print('Rename or remove the duplicates, then run this script '
+                  'again to create the indexes')
+            raise SystemExit(1)
+        print('No duplicates')
+    if args.check_counts or args.repair_counts:
+        with engine.begin() as conn:
+            mismatches = item_count_mismatches(conn)
+            for m in mismatches:
+                print('%s (id %d): item_count %d, actual %d' % (
+                    m.name, m.id, m.item_count, m.actual))
+            if args.repair_counts:
+                repair_item_counts(conn)
+                print('Repaired %d categories' % len(mismatches))
+            elif mismatches:
+                raise SystemExit(1)
+            else:
+                print('All item counts are consistent')
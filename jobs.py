@@ -0,0 +1,212 @@
+# In-process background job queue with a persistent SQLite outbox
+#
+# Jobs are written to the outbox before they run, so work enqueued after a
+# commit survives a crash or restart. A dispatcher thread hands due jobs to
+# a thread pool and failed jobs are retried with exponential backoff.
+#
+# Several processes may share one outbox. A job is claimed with a lease
+# naming the owning process, which renews the leases of its running jobs
+# while it is alive. A job whose lease expired, because its process died,
+# is claimed again by any process.
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+
+OUTBOX_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'pending',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        created_at REAL NOT NULL,
+        run_at REAL NOT NULL,
+        error TEXT,
+        claimed_by TEXT,
+        lease_until REAL
+    )'''
+
+# Columns added since the first version of the outbox
+OUTBOX_UPGRADES = [('claimed_by', 'TEXT'), ('lease_until', 'REAL')]
+
+# Due jobs: pending ones, and running ones whose owner stopped renewing
+DUE_JOBS = ("(status = 'pending' AND run_at <= :now) OR "
+            "(status = 'running' AND "
+            "(lease_until IS NULL OR lease_until < :now))")
+
+
+class JobQueue(object):
+    """Runs registered handlers for enqueued jobs on a pool of workers"""
+
+    def __init__(self, path, workers=2, max_attempts=5, backoff=1.0,
+                 lease=60.0):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.lease = lease
+        self.owner = '%s:%d:%x' % (socket.gethostname(), os.getpid(),
+                                   id(self))
+        self.handlers = {}
+        self.processed = 0
+        self.retries = 0
+        self.latency_seconds = 0.0
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = False
+        self._pool = ThreadPoolExecutor(max_workers=workers,
+                                        thread_name_prefix='jobs')
+        self._renewed = 0.0
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(OUTBOX_SCHEMA)
+            columns = [row[1] for row in
+                       conn.execute('PRAGMA table_info(outbox)')]
+            for column, kind in OUTBOX_UPGRADES:
+                if column not in columns:
+                    conn.execute('ALTER TABLE outbox ADD COLUMN %s %s'
+                                 % (column, kind))
+        self._dispatcher = threading.Thread(target=self._dispatch,
+                                            name='jobs-dispatcher',
+                                            daemon=True)
+        self._dispatcher.start()
+
+    @contextmanager
+    def _connect(self):
+        # One short transaction per use, several processes may share the file
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def handler(self, name):
+        """Decorator registering the function that runs jobs called name"""
+        def register(f):
+            self.handlers[name] = f
+            return f
+        return register
+
+    def enqueue(self, name, payload=None):
+        """Persist a job, its handler is called with the payload dict as
+        keyword arguments"""
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute('INSERT INTO outbox (name, payload, created_at, '
+                         'run_at) VALUES (?, ?, ?, ?)',
+                         (name, json.dumps(payload or {}), now, now))
+        self._wakeup.set()
+
+    def stop(self, wait=True):
+        self._stopping = True
+        self._wakeup.set()
+        # No job may be claimed once the pool stops taking them
+        self._dispatcher.join()
+        self._pool.shutdown(wait=wait)
+
+    def _dispatch(self):
+        while not self._stopping:
+            try:
+                self._dispatch_due()
+            except Exception:
+                log.exception('job dispatch failed')
+                self._wakeup.wait(1.0)
+                self._wakeup.clear()
+
+    def _dispatch_due(self):
+        """Claim the due jobs, hand them to the pool and wait for the next
+        one to be due"""
+        now = time.time()
+        with self._connect() as conn:
+            if now - self._renewed >= self.lease / 3:
+                conn.execute(
+                    "UPDATE outbox SET lease_until = ? "
+                    "WHERE status = 'running' AND claimed_by = ?",
+                    (now + self.lease, self.owner))
+                self._renewed = now
+            due = conn.execute(
+                "SELECT id, name, payload, attempts, created_at "
+                "FROM outbox WHERE " + DUE_JOBS +
+                " ORDER BY run_at LIMIT 100", {'now': now}).fetchall()
+            # Claim each job, another process may have taken it already
+            due = [job for job in due if conn.execute(
+                "UPDATE outbox SET status = 'running', claimed_by = "
+                ":owner, lease_until = :lease WHERE id = :id AND (" +
+                DUE_JOBS + ")",
+                {'owner': self.owner, 'lease': now + self.lease,
+                 'id': job[0], 'now': now}).rowcount == 1]
+            next_run = conn.execute(
+                "SELECT MIN(run_at) FROM outbox "
+                "WHERE status = 'pending'").fetchone()[0]
+        for n, job in enumerate(due):
+            try:
+                self._pool.submit(self._run, *job)
+            except RuntimeError:
+                # The pool is shut down, give the rest back to the outbox
+                self._release([job[0] for job in due[n:]])
+                raise
+        # Wake up in time to renew the leases
+        longest = min(1.0, self.lease / 3)
+        timeout = longest if next_run is None else \
+            min(max(next_run - time.time(), 0.01), longest)
+        self._wakeup.wait(timeout)
+        self._wakeup.clear()
+
+    def _release(self, job_ids):
+        with self._connect() as conn:
+            conn.executemany(
+                "UPDATE outbox SET status = 'pending', claimed_by = NULL "
+                "WHERE id = ? AND claimed_by = ?",
+                [(job_id, self.owner) for job_id in job_ids])
+
+    def _run(self, job_id, name, payload, attempts, created_at):
+        try:
+            self.handlers[name](**json.loads(payload))
+        except Exception as e:
+            attempts += 1
+            log.exception('job %s %d failed (attempt %d)',
+                          name, job_id, attempts)
+            with self._connect() as conn:
+                if attempts >= self.max_attempts:
+                    conn.execute("UPDATE outbox SET status = 'failed', "
+                                 "attempts = ?, error = ?, claimed_by = NULL "
+                                 "WHERE id = ? AND claimed_by = ?",
+                                 (attempts, repr(e), job_id, self.owner))
+                else:
+                    conn.execute(
+                        "UPDATE outbox SET status = 'pending', attempts = ?, "
+                        "error = ?, run_at = ?, claimed_by = NULL "
+                        "WHERE id = ? AND claimed_by = ?",
+                        (attempts, repr(e),
+                         time.time() + self.backoff * 2 ** (attempts - 1),
+                         job_id, self.owner))
+                    with self._lock:
+                        self.retries += 1
+            self._wakeup.set()
+            return
+        with self._connect() as conn:
+            conn.execute('DELETE FROM outbox WHERE id = ?', (job_id,))
+        with self._lock:
+            self.processed += 1
+            self.latency_seconds += time.time() - created_at
+
+    @property
+    def stats(self):
+        with self._connect() as conn:
+            depth = dict(conn.execute(
+                'SELECT status, COUNT(*) FROM outbox GROUP BY status'))
+        with self._lock:
+            return {'pending': depth.get('pending', 0),
+                    'running': depth.get('running', 0),
+                    'failed': depth.get('failed', 0),
+                    'processed': self.processed,
+                    'retries': self.retries,
+                    'latency_seconds': self.latency_seconds}
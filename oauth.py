@@ -0,0 +1,112 @@
+# Google OAuth2 helpers shared by the gconnect and gdisconnect routes
+#
+# The flow is built once and all outbound calls go through one pooled
+# keep-alive HTTP session. Endpoint URLs can be pointed at a local stand-in
+# for Google through the environment. oauth2client, httplib2 and requests
+# are only imported when the first login happens, so importing this module
+# is cheap.
+import json
+import os
+import threading
+
+from cache import TTLCache
+
+CLIENT_SECRETS = os.environ.get('CLIENT_SECRETS', 'client_secrets.json')
+TOKENINFO_URL = os.environ.get(
+    'GOOGLE_TOKENINFO_URL', 'https://www.googleapis.com/oauth2/v1/tokeninfo')
+USERINFO_URL = os.environ.get(
+    'GOOGLE_USERINFO_URL', 'https://www.googleapis.com/oauth2/v1/userinfo')
+REVOKE_URL = os.environ.get(
+    'GOOGLE_REVOKE_URL', 'https://accounts.google.com/o/oauth2/revoke')
+
+# Seconds to wait for Google (connect, read) and connections kept per host
+TIMEOUT = (3.05, 10)
+POOL_SIZE = 10
+
+# Validated token info, kept for the remaining lifetime of each token
+token_cache = TTLCache(ttl=None, maxsize=10000)
+
+_lock = threading.Lock()
+_client_id = None
+_flow = None
+_http_session = None
+
+
+class CodeExchangeError(Exception):
+    """The authorization code could not be upgraded to credentials"""
+
+
+def client_id():
+    """The OAuth client id from CLIENT_SECRETS, read on first use"""
+    global _client_id
+    if _client_id is None:
+        with open(CLIENT_SECRETS) as f:
+            secrets = json.load(f)
+        _client_id = (secrets.get('web') or secrets['installed'])['client_id']
+    return _client_id
+
+
+def get_flow():
+    global _flow
+    with _lock:
+        if _flow is None:
+            from oauth2client.client import flow_from_clientsecrets
+            _flow = flow_from_clientsecrets(CLIENT_SECRETS, scope='')
+            _flow.redirect_uri = 'postmessage'
+        return _flow
+
+
+def get_http_session():
+    global _http_session
+    with _lock:
+        if _http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            http_session = requests.Session()
+            for prefix in ('https://', 'http://'):
+                http_session.mount(prefix, HTTPAdapter(
+                    pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE))
+            _http_session = http_session
+        return _http_session
+
+
+def exchange_code(code):
+    """Upgrade an authorization code into a credentials object"""
+    import httplib2
+    from oauth2client.client import FlowExchangeError
+    try:
+        return get_flow().step2_exchange(
+            code, http=httplib2.Http(timeout=TIMEOUT[1]))
+    except FlowExchangeError as e:
+        raise CodeExchangeError(str(e))
+
+
+def get_token_info(access_token):
+    """Return Google's token info for access_token, from the cache while the
+    token is still valid. Error responses are not cached"""
+    found, info = token_cache.lookup(access_token)
+    if found:
+        return info
+    info = get_http_session().get(TOKENINFO_URL,
+                                  params={'access_token': access_token},
+                                  timeout=TIMEOUT).json()
+    if info.get('error') is None:
+        expires_in = int(info.get('expires_in', 0))
+        if expires_in > 0:
+            token_cache.set(access_token, info, ttl=expires_in)
+    return info
+
+
+def get_user_info(access_token):
+    return get_http_session().get(USERINFO_URL,
+                                  params={'access_token': access_token,
+                                          'alt': 'json'},
+                                  timeout=TIMEOUT).json()
+
+
+def revoke_token(access_token):
+    """Revoke access_token, returns True if Google accepted it"""
+    token_cache.invalidate(access_token)
+    response = get_http_session().get(
+        REVOKE_URL, params={'token': access_token}, timeout=TIMEOUT)
+    return response.status_code == 200
@@ -0,0 +1,240 @@
+# Request instrumentation, Prometheus metrics and a sampling profiler
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import Response, g, has_request_context, request
+from flask import before_render_template, template_rendered
+from sqlalchemy import event
+
+# Request duration histogram buckets in seconds
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace(
+        '"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, escape_label(v))
+                             for k, v in sorted(labels.items()))
+
+
+class Metrics(object):
+    """Aggregates per-endpoint request timings and renders them, along with
+    any registered collectors, in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()
+        self.durations = defaultdict(float)
+        self.buckets = defaultdict(lambda: [0] * len(BUCKETS))
+        self.sql_queries = Counter()
+        self.sql_seconds = defaultdict(float)
+        self.template_seconds = defaultdict(float)
+        self.collectors = []
+
+    def add_collector(self, collector):
+        """Register a callable returning (name, type, help, samples) tuples,
+        where samples is a list of (labels dict, value)"""
+        self.collectors.append(collector)
+
+    def observe(self, endpoint, method, status, duration, queries,
+                sql_seconds, template_seconds):
+        with self._lock:
+            self.requests[(endpoint, method, status)] += 1
+            self.durations[endpoint] += duration
+            counts = self.buckets[endpoint]
+            for n, bound in enumerate(BUCKETS):
+                if duration <= bound:
+                    counts[n] += 1
+            self.sql_queries[endpoint] += queries
+            self.sql_seconds[endpoint] += sql_seconds
+            self.template_seconds[endpoint] += template_seconds
+
+    def families(self):
+        with self._lock:
+            requests = [({'endpoint': e, 'method': m, 'status': s}, v)
+                        for (e, m, s), v in sorted(self.requests.items())]
+            histogram = []
+            for endpoint, counts in sorted(self.buckets.items()):
+                total = sum(v for (e, m, s), v in self.requests.items()
+                            if e == endpoint)
+                for bound, count in zip(BUCKETS, counts):
+                    histogram.append(('_bucket', {'endpoint': endpoint,
+                                                  'le': bound}, count))
+                histogram.append(('_bucket', {'endpoint': endpoint,
+                                              'le': '+Inf'}, total))
+                histogram.append(('_sum', {'endpoint': endpoint},
+                                  self.durations[endpoint]))
+                histogram.append(('_count', {'endpoint': endpoint}, total))
+            families = [
+                ('catalog_requests_total', 'counter',
+                 'Requests handled', requests),
+                ('catalog_request_duration_seconds', 'histogram',
+                 'Request wall time', histogram),
+                ('catalog_sql_queries_total', 'counter',
+                 'SQL statements executed while handling requests',
+                 [({'endpoint': e}, v)
+                  for e, v in sorted(self.sql_queries.items())]),
+                ('catalog_sql_duration_seconds_total', 'counter',
+                 'Time spent executing SQL statements',
+                 [({'endpoint': e}, v)
+                  for e, v in sorted(self.sql_seconds.items())]),
+                ('catalog_template_render_seconds_total', 'counter',
+                 'Time spent rendering templates',
+                 [({'endpoint': e}, v)
+                  for e, v in sorted(self.template_seconds.items())]),
+            ]
+        for collector in self.collectors:
+            families.extend(collector())
+        return families
+
+    def render(self):
+        lines = []
+        for name, kind, help_text, samples in self.families():
+            lines.append('# HELP %s %s' % (name, help_text))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for sample in samples:
+                if kind == 'histogram':
+                    suffix, labels, value = sample
+                else:
+                    suffix, (labels, value) = '', sample
+                lines.append('%s%s%s %s' % (name, suffix,
+                                            format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+class Sampler(threading.Thread):
+    """Samples the stacks of threads that are handling requests and keeps
+    them per thread in collapsed (flamegraph) form"""
+
+    def __init__(self, interval=0.005):
+        threading.Thread.__init__(self, name='profiling-sampler', daemon=True)
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._stacks = {}
+
+    def start_thread(self, ident):
+        with self._lock:
+            self._stacks[ident] = Counter()
+
+    def stop_thread(self, ident):
+        with self._lock:
+            return self._stacks.pop(ident, Counter())
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            frames = sys._current_frames()
+            with self._lock:
+                for ident, stacks in self._stacks.items():
+                    frame = frames.get(ident)
+                    names = []
+                    while frame is not None:
+                        code = frame.f_code
+                        names.append('%s (%s:%d)' % (
+                            code.co_name, os.path.basename(code.co_filename),
+                            code.co_firstlineno))
+                        frame = frame.f_back
+                    if names:
+                        stacks[';'.join(reversed(names))] += 1
+
+
+class Profiler(object):
+    """Opt-in per-request instrumentation of a Flask app. Adds a
+    Server-Timing header with wall, SQL and template time to every
+    response and feeds the totals to `metrics`. With a sample_dir, requests
+    slower than slow_ms have their sampled stacks written there"""
+
+    def __init__(self, metrics, sample_dir=None, slow_ms=500,
+                 interval=0.005):
+        self.metrics = metrics
+        self.sample_dir = sample_dir
+        self.slow_ms = slow_ms
+        self.sampler = None
+        if sample_dir:
+            os.makedirs(sample_dir, exist_ok=True)
+            self.sampler = Sampler(interval)
+            self.sampler.start()
+
+    def init_app(self, app):
+        app.before_request(self.before_request)
+        app.after_request(self.after_request)
+        before_render_template.connect(self.before_render, app)
+        template_rendered.connect(self.after_render, app)
+
+    def watch_engine(self, engine):
+        event.listen(engine, 'before_cursor_execute', self.before_execute)
+        event.listen(engine, 'after_cursor_execute', self.after_execute)
+        event.listen(engine, 'handle_error', self.execute_failed)
+
+    def before_request(self):
+        g.profile_start = time.perf_counter()
+        g.profile_queries = 0
+        g.profile_sql = 0.0
+        g.profile_template = 0.0
+        g.profile_render_start = []
+        if self.sampler:
+            self.sampler.start_thread(threading.get_ident())
+
+    def after_request(self, response):
+        if 'profile_start' not in g:
+            return response
+        duration = time.perf_counter() - g.profile_start
+        endpoint = request.endpoint or 'unknown'
+        response.headers['Server-Timing'] = (
+            'app;dur=%.2f, db;dur=%.2f;desc="%d queries", tpl;dur=%.2f' % (
+                duration * 1000, g.profile_sql * 1000, g.profile_queries,
+                g.profile_template * 1000))
+        self.metrics.observe(endpoint, request.method, response.status_code,
+                             duration, g.profile_queries, g.profile_sql,
+                             g.profile_template)
+        if self.sampler:
+            stacks = self.sampler.stop_thread(threading.get_ident())
+            if duration * 1000 >= self.slow_ms and stacks:
+                self.write_stacks(endpoint, duration, stacks)
+        return response
+
+    def write_stacks(self, endpoint, duration, stacks):
+        filename = os.path.join(self.sample_dir, '%s-%s-%dms.folded' % (
+            time.strftime('%Y%m%d-%H%M%S'), endpoint, duration * 1000))
+        with open(filename, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write('%s %d\n' % (stack, count))
+
+    def before_render(self, sender, template, context, **extra):
+        if has_request_context() and 'profile_render_start' in g:
+            g.profile_render_start.append(time.perf_counter())
+
+    def after_render(self, sender, template, context, **extra):
+        if has_request_context() and g.get('profile_render_start'):
+            g.profile_template += (time.perf_counter() -
+                                   g.profile_render_start.pop())
+
+    def before_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        conn.info.setdefault('profile_query_start', []).append(
+            time.perf_counter())
+
+    def after_execute(self, conn, cursor, statement, parameters, context,
+                      executemany):
+        start = conn.info['profile_query_start'].pop()
+        if has_request_context() and 'profile_queries' in g:
+            g.profile_queries += 1
+            g.profile_sql += time.perf_counter() - start
+
+    def execute_failed(self, context):
+        starts = context.connection.info.get('profile_query_start')
+        if starts:
+            starts.pop()
+
+
+def metrics_response(metrics):
+    return Response(metrics.render(),
+                    mimetype='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,262 @@
+# Routing of ORM sessions between the primary database and read replicas
+#
+# RoutingSession reads through a replica and writes to the primary. Once a
+# session flushes it stays on the primary for the rest of its life. Replica
+# lag is measured from a heartbeat row that the primary updates every
+# `heartbeat_interval` seconds. Only one process per database writes the
+# heartbeat, the one holding a lock file, and another takes over when it
+# exits. A replica is skipped while it is more than `max_lag` seconds
+# behind, or while it has not caught up with the last commit made by this
+# process or, through `last_commit`, by any process sharing the catalog
+# version. Caches filled after a write, in any worker, never hold older
+# data. Reads fall back to the primary when no replica qualifies.
+import hashlib
+import itertools
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event, select
+from sqlalchemy.engine import make_url
+from sqlalchemy.orm import Session
+
+from database_setup import Heartbeat, get_engine
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+heartbeat_table = Heartbeat.__table__
+
+
+def readonly_url(url):
+    """A read-only URL for the SQLite database file at url"""
+    url = make_url(url)
+    if url.get_backend_name() != 'sqlite' or \
+            url.database in (None, '', ':memory:'):
+        raise ValueError('read-only replicas need a SQLite database file, '
+                         'not %s' % url)
+    return 'sqlite:///file:%s?mode=ro&uri=true' % \
+        os.path.abspath(url.database)
+
+
+def lock_path(url):
+    """The heartbeat lock file of the database at url, next to it for a
+    SQLite file, in the temp dir otherwise"""
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and \
+            url.database not in (None, '', ':memory:'):
+        return os.path.abspath(url.database) + '-heartbeat.lock'
+    return os.path.join(tempfile.gettempdir(), 'catalog-heartbeat-%s.lock'
+                        % hashlib.sha1(str(url).encode('utf-8')).hexdigest())
+
+
+class ProcessLock(object):
+    """An exclusive lock on a file, held until the process exits. Without
+    fcntl every process holds it"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    @property
+    def held(self):
+        return fcntl is None or self._file is not None
+
+    def acquire(self):
+        """Take the lock if it is free, return whether this process holds
+        it"""
+        if self.held:
+            return True
+        f = open(self.path, 'a')
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            f.close()
+            return False
+        self._file = f
+        return True
+
+
+class HeartbeatThread(threading.Thread):
+    """Updates the heartbeat row of the primary every `interval` seconds
+    while this process holds the heartbeat lock"""
+
+    def __init__(self, router, interval):
+        threading.Thread.__init__(self, name='replica-heartbeat',
+                                  daemon=True)
+        self.router = router
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                if self.router.lock.acquire():
+                    self.router.beat()
+            except Exception:
+                log.exception('replica heartbeat failed')
+
+
+class Router(object):
+    """Chooses the engine for reads and counts queries per engine"""
+
+    def __init__(self, primary, replicas=(), max_lag=5.0,
+                 heartbeat_interval=1.0, last_commit=None):
+        self.primary = primary
+        # Returns the time of the last commit by any process, if known
+        self.last_commit = last_commit
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.heartbeat_interval = heartbeat_interval
+        self.names = {primary: 'primary'}
+        for n, replica in enumerate(self.replicas):
+            self.names[replica] = 'replica%d' % (n + 1)
+        self.queries = dict((name, 0) for name in self.names.values())
+        self.fallbacks = 0
+        self.last_write = 0.0
+        self.lock = ProcessLock(lock_path(primary.url))
+        # Replica -> (time measured, heartbeat seen), None if unreachable
+        self._heartbeats = {}
+        self._next = itertools.count()
+        self._lock = threading.Lock()
+        for engine, name in self.names.items():
+            self._count_queries(engine, name)
+
+    @classmethod
+    def from_urls(cls, primary, urls, **kwargs):
+        """Open a replica engine for each URL. `readonly` stands for a
+        read-only connection pool to the primary's SQLite file. That is
+        the same file, so it exercises the routing without taking any
+        load off the primary"""
+        replicas = []
+        for url in urls:
+            if url == 'readonly':
+                replicas.append(get_engine(readonly_url(primary.url),
+                                           wal=False))
+            else:
+                replicas.append(get_engine(url))
+        return cls(primary, replicas, **kwargs)
+
+    def _count_queries(self, engine, name):
+        def count(*args):
+            with self._lock:
+                self.queries[name] += 1
+        event.listen(engine, 'before_cursor_execute', count)
+
+    @property
+    def engines(self):
+        return [self.primary] + self.replicas
+
+    def start(self):
+        """Write the first heartbeat and keep it updated, if there are
+        replicas and no other process does"""
+        if self.replicas:
+            if self.lock.acquire():
+                self.beat()
+            HeartbeatThread(self, self.heartbeat_interval).start()
+
+    def beat(self):
+        with self.primary.begin() as conn:
+            now = time.time()
+            updated = conn.execute(heartbeat_table.update().where(
+                heartbeat_table.c.id == 1).values(written_at=now))
+            if not updated.rowcount:
+                conn.execute(heartbeat_table.insert().values(
+                    id=1, written_at=now))
+
+    def wrote(self):
+        """Record a commit to the primary by this process"""
+        self.last_write = time.time()
+
+    def heartbeat(self, replica):
+        """The last heartbeat the replica has seen, measured at most once
+        per heartbeat interval. None if it can't be read"""
+        now = time.monotonic()
+        measured = self._heartbeats.get(replica)
+        if measured is not None and \
+                now - measured[0] < self.heartbeat_interval:
+            return measured[1]
+        try:
+            with replica.connect() as conn:
+                seen = conn.execute(select(heartbeat_table.c.written_at)
+                                    .where(heartbeat_table.c.id == 1)
+                                    ).scalar()
+        except Exception:
+            log.exception('cannot read the heartbeat of %s',
+                          self.names[replica])
+            seen = None
+        self._heartbeats[replica] = (now, seen)
+        return seen
+
+    def lag(self, replica):
+        """Seconds the replica is behind the primary, None if unknown"""
+        seen = self.heartbeat(replica)
+        return None if seen is None else max(time.time() - seen, 0.0)
+
+    def usable(self, replica):
+        seen = self.heartbeat(replica)
+        if seen is None or time.time() - seen > self.max_lag:
+            return False
+        last_write = self.last_write
+        if self.last_commit is not None:
+            last_write = max(last_write, self.last_commit())
+        return seen >= last_write
+
+    def read_engine(self):
+        """A replica that is up to date enough, round robin, otherwise the
+        primary"""
+        if not self.replicas:
+            return self.primary
+        start = next(self._next)
+        for n in range(len(self.replicas)):
+            replica = self.replicas[(start + n) % len(self.replicas)]
+            if self.usable(replica):
+                return replica
+        with self._lock:
+            self.fallbacks += 1
+        return self.primary
+
+    @property
+    def stats(self):
+        with self._lock:
+            queries = dict(self.queries)
+            fallbacks = self.fallbacks
+        return {'queries': queries, 'fallbacks': fallbacks,
+                'heartbeat_writer': self.lock.held,
+                'lag': dict((self.names[r], self.lag(r))
+                            for r in self.replicas)}
+
+
+class RoutingSession(Session):
+    """A Session that reads from router.read_engine() until it writes or
+    use_primary is set. Without a router it behaves like Session"""
+
+    def __init__(self, router=None, **kwargs):
+        Session.__init__(self, **kwargs)
+        self.router = router
+        self.use_primary = False
+        self.wrote = False
+        self._read_engine = None
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if self.router is None:
+            return Session.get_bind(self, mapper, clause, **kwargs)
+        if self._flushing or getattr(clause, 'is_dml', False):
+            self.use_primary = self.wrote = True
+        if self.use_primary:
+            return self.router.primary
+        # One replica per session, so its reads are consistent
+        if self._read_engine is None:
+            self._read_engine = self.router.read_engine()
+        return self._read_engine
+
+    def commit(self):
+        Session.commit(self)
+        if self.wrote and self.router is not None:
+            self.router.wrote()
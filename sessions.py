@@ -0,0 +1,227 @@
+# Server-side Flask sessions
+#
+# The session cookie only carries a random id. Session data is kept in a
+# store, either an in-process LRU or a SQLite file shared by every worker,
+# and expires after `ttl` seconds without a request.
+import logging
+import secrets
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from flask.json.tag import TaggedJSONSerializer
+from flask.sessions import SecureCookieSession, SessionInterface
+
+from cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+SESSION_SCHEMA = '''
+    CREATE TABLE IF NOT EXISTS sessions (
+        id TEXT PRIMARY KEY,
+        data TEXT NOT NULL,
+        expires REAL NOT NULL
+    )'''
+
+
+# ======================
+# Stores
+# ======================
+
+class MemoryStore(object):
+    """Keeps sessions in a per-process LRU. Only suitable when the app runs
+    in a single process"""
+
+    def __init__(self, maxsize=10000):
+        self._entries = TTLCache(ttl=None, maxsize=maxsize)
+
+    def load(self, sid):
+        """Return (data, expires) for a live session, otherwise None"""
+        return self._entries.lookup(sid)[1]
+
+    def save(self, sid, data, expires):
+        self._entries.set(sid, (data, expires), ttl=expires - time.time())
+
+    def delete(self, sid):
+        self._entries.invalidate(sid)
+
+    def sweep(self):
+        return self._entries.expire()
+
+    def size(self):
+        return len(self._entries)
+
+
+class SQLiteStore(object):
+    """Keeps sessions in a SQLite file that several processes may share"""
+
+    def __init__(self, path):
+        self.path = path
+        with self._connect() as conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute(SESSION_SCHEMA)
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_sessions_expires '
+                         'ON sessions (expires)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def load(self, sid):
+        with self._connect() as conn:
+            return conn.execute(
+                'SELECT data, expires FROM sessions '
+                'WHERE id = ? AND expires > ?', (sid, time.time())).fetchone()
+
+    def save(self, sid, data, expires):
+        with self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO sessions (id, data, expires) '
+                         'VALUES (?, ?, ?)', (sid, data, expires))
+
+    def delete(self, sid):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM sessions WHERE id = ?', (sid,))
+
+    def sweep(self):
+        with self._connect() as conn:
+            return conn.execute('DELETE FROM sessions WHERE expires <= ?',
+                                (time.time(),)).rowcount
+
+    def size(self):
+        with self._connect() as conn:
+            return conn.execute('SELECT COUNT(*) FROM sessions').fetchone()[0]
+
+
+# ======================
+# Session interface
+# ======================
+
+class ServerSession(SecureCookieSession):
+    """Session dict that remembers its id in the store"""
+
+    def __init__(self, initial=None, sid=None, refresh=False):
+        SecureCookieSession.__init__(self, initial)
+        self.sid = sid
+        self.refresh = refresh
+        # The id in the request's cookie
+        self.loaded_sid = sid
+
+    def regenerate(self):
+        """Move the session to a new id, so that an id known before a login
+        or logout is worthless after it. The old id is deleted from the
+        store when the session is saved"""
+        self.sid = secrets.token_urlsafe(32)
+        self.modified = True
+
+
+class Sweeper(threading.Thread):
+    """Removes expired sessions from a store every `interval` seconds"""
+
+    def __init__(self, interface, interval):
+        threading.Thread.__init__(self, name='session-sweeper', daemon=True)
+        self.interface = interface
+        self.interval = interval
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                removed = self.interface.store.sweep()
+            except Exception:
+                log.exception('session sweep failed')
+                continue
+            with self.interface._lock:
+                self.interface.expired += removed
+
+
+class ServerSessionInterface(SessionInterface):
+    """Flask session interface keeping session data in `store`. Sessions
+    expire `ttl` seconds after they were last saved, and are saved again
+    when they are changed or half of their lifetime has passed"""
+
+    session_class = ServerSession
+    serializer = TaggedJSONSerializer()
+
+    def __init__(self, store, ttl=86400, sweep_interval=300):
+        self.store = store
+        self.ttl = ttl
+        self.lookups = 0
+        self.misses = 0
+        self.lookup_seconds = 0.0
+        self.expired = 0
+        self._lock = threading.Lock()
+        self.sweeper = None
+        if sweep_interval:
+            self.sweeper = Sweeper(self, sweep_interval)
+            self.sweeper.start()
+
+    def open_session(self, app, request):
+        sid = request.cookies.get(self.get_cookie_name(app))
+        if not sid:
+            return self.session_class()
+        start = time.perf_counter()
+        entry = self.store.load(sid)
+        with self._lock:
+            self.lookups += 1
+            self.lookup_seconds += time.perf_counter() - start
+            if entry is None:
+                self.misses += 1
+        if entry is None:
+            return self.session_class()
+        data, expires = entry
+        return self.session_class(self.serializer.loads(data), sid,
+                                  refresh=expires - time.time() < self.ttl / 2)
+
+    def save_session(self, app, session, response):
+        name = self.get_cookie_name(app)
+        domain = self.get_cookie_domain(app)
+        path = self.get_cookie_path(app)
+        secure = self.get_cookie_secure(app)
+        samesite = self.get_cookie_samesite(app)
+        httponly = self.get_cookie_httponly(app)
+
+        if session.accessed:
+            response.vary.add('Cookie')
+
+        # Sessions emptied by this request are removed with their cookie
+        if not session:
+            if session.modified and session.loaded_sid is not None:
+                self.store.delete(session.loaded_sid)
+                response.delete_cookie(name, domain=domain, path=path,
+                                       secure=secure, samesite=samesite,
+                                       httponly=httponly)
+                response.vary.add('Cookie')
+            return
+
+        if session.sid is None:
+            session.sid = secrets.token_urlsafe(32)
+        new = session.sid != session.loaded_sid
+        if new and session.loaded_sid is not None:
+            # Regenerated, the old id must not load it any more
+            self.store.delete(session.loaded_sid)
+        if new or session.modified or session.refresh:
+            self.store.save(session.sid,
+                            self.serializer.dumps(dict(session)),
+                            time.time() + self.ttl)
+        if new or self.should_set_cookie(app, session):
+            response.set_cookie(name, session.sid,
+                                expires=self.get_expiration_time(app, session),
+                                httponly=httponly, domain=domain, path=path,
+                                secure=secure, samesite=samesite)
+            response.vary.add('Cookie')
+
+    @property
+    def stats(self):
+        size = self.store.size()
+        with self._lock:
+            return {'lookups': self.lookups,
+                    'misses': self.misses,
+                    'lookup_seconds': self.lookup_seconds,
+                    'expired': self.expired,
+                    'size': size}
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3.7
+# Compressed snapshots of the whole catalog, for backups and warming up
+# new replicas
+#
+# Usage: python snapshot.py export FILE [--encoding msgpack|json]
+#        python snapshot.py import FILE
+#        python snapshot.py verify FILE
+#
+# A snapshot is a gzip stream of length prefixed frames. The first frame is
+# a JSON header naming the payload encoding, then every table is written in
+# blocks of up to BLOCK_ROWS rows stored column by column, and the last
+# frame is a JSON trailer with row counts and the SHA-256 of every frame
+# before it. Blocks are msgpack encoded when the msgpack package is
+# installed, JSON otherwise.
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import struct
+import sys
+import time
+import zlib
+
+from sqlalchemy import DateTime, select
+from database_setup import *
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+FORMAT = 'catalog-snapshot'
+FORMAT_VERSION = 1
+BLOCK_ROWS = 10000
+# Tables in insert order
+TABLES = [User.__table__, Category.__table__, Items.__table__]
+FRAME_HEADER = struct.Struct('>I')
+
+
+class SnapshotError(Exception):
+    pass
+
+
+def default_encoding():
+    return 'msgpack' if msgpack is not None else 'json'
+
+
+def encode(value, encoding):
+    if encoding == 'msgpack':
+        return msgpack.packb(value, use_bin_type=True)
+    return json.dumps(value, separators=(',', ':')).encode('utf-8')
+
+
+def decode(data, encoding):
+    try:
+        if encoding == 'msgpack':
+            return msgpack.unpackb(data, raw=False)
+        return json.loads(data.decode('utf-8'))
+    except ValueError as e:
+        raise SnapshotError('corrupt snapshot: %s' % e)
+
+
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+# ======================
+# Export
+# ======================
+
+def export_frames(engine, encoding=None):
+    """Yield the uncompressed frames of a snapshot of every table, read in
+    a single transaction"""
+    encoding = encoding or default_encoding()
+    if encoding == 'msgpack' and msgpack is None:
+        raise SnapshotError('msgpack is not installed')
+    digest = hashlib.sha256()
+    counts = {}
+
+    header = encode({'format': FORMAT, 'version': FORMAT_VERSION,
+                     'encoding': encoding,
+                     'created': datetime.datetime.utcnow().isoformat()},
+                    'json')
+    digest.update(header)
+    yield frame(header)
+
+    with engine.connect() as conn:
+        if engine.dialect.name == 'sqlite':
+            # pysqlite only opens transactions for writes, without one each
+            # table would be read at a different point in time
+            conn.exec_driver_sql('BEGIN')
+        for table in TABLES:
+            columns = [c.name for c in table.columns]
+            counts[table.name] = 0
+            result = conn.execution_options(stream_results=True).execute(
+                select(table).order_by(table.c.id))
+            for rows in result.partitions(BLOCK_ROWS):
+                data = [list(values) for values in zip(*rows)]
+                for n, column in enumerate(table.columns):
+                    if isinstance(column.type, DateTime):
+                        data[n] = [v.isoformat() if v else v
+                                   for v in data[n]]
+                block = encode({'table': table.name, 'columns': columns,
+                                'data': data}, encoding)
+                digest.update(block)
+                counts[table.name] += len(rows)
+                yield frame(block)
+
+    yield frame(encode({'counts': counts, 'sha256': digest.hexdigest()},
+                       'json'))
+
+
+def compress(frames, level=6):
+    """Gzip a stream of frames incrementally"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for data in frames:
+        chunk = compressor.compress(data)
+        if chunk:
+            yield chunk
+    yield compressor.flush()
+
+
+def export_snapshot(engine, path, encoding=None):
+    with open(path, 'wb') as f:
+        for chunk in compress(export_frames(engine, encoding)):
+            f.write(chunk)
+
+
+# ======================
+# Import
+# ======================
+
+def read_frames(f):
+    """Yield frame payloads from a decompressed snapshot stream"""
+    while True:
+        size = f.read(FRAME_HEADER.size)
+        if not size:
+            return
+        if len(size) < FRAME_HEADER.size:
+            raise SnapshotError('truncated snapshot')
+        size, = FRAME_HEADER.unpack(size)
+        payload = f.read(size)
+        if len(payload) < size:
+            raise SnapshotError('truncated snapshot')
+        yield payload
+
+
+def read_blocks(f):
+    """Yield (table name, list of row dicts) for every block of a
+    snapshot, then check the trailer. Raises SnapshotError if the snapshot
+    is truncated or corrupt, so rows must not be committed before the
+    generator is exhausted"""
+    frames = read_frames(f)
+    digest = hashlib.sha256()
+    payload = next(frames, None)
+    if payload is None:
+        raise SnapshotError('empty snapshot')
+    header = decode(payload, 'json')
+    if header.get('format') != FORMAT or \
+            header.get('version') != FORMAT_VERSION:
+        raise SnapshotError('not a version %d catalog snapshot'
+                            % FORMAT_VERSION)
+    encoding = header['encoding']
+    if encoding == 'msgpack' and msgpack is None:
+        raise SnapshotError('the snapshot is msgpack encoded, but msgpack '
+                            'is not installed')
+    digest.update(payload)
+
+    counts = {}
+    previous = None
+    for payload in frames:
+        if previous is not None:
+            digest.update(previous)
+            block = decode(previous, encoding)
+            rows = [dict(zip(block['columns'], values))
+                    for values in zip(*block['data'])]
+            counts[block['table']] = counts.get(block['table'], 0) + \
+                len(rows)
+            yield block['table'], rows
+        previous = payload
+
+    if previous is None:
+        raise SnapshotError('the snapshot has no trailer')
+    trailer = decode(previous, 'json')
+    if trailer.get('sha256') != digest.hexdigest():
+        raise SnapshotError('checksum mismatch')
+    if dict((k, v) for k, v in trailer['counts'].items() if v) != counts:
+        raise SnapshotError('row counts do not match the trailer')
+
+
+def import_snapshot(engine, path):
+    """Replace the contents of the database with a snapshot in a single
+    transaction, return the number of rows loaded per table"""
+    tables = dict((t.name, t) for t in TABLES)
+    counts = dict((t.name, 0) for t in TABLES)
+    with gzip.open(path, 'rb') as f, engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            # Begin before the trigger DDL, pysqlite only opens transactions
+            # for writes
+            conn.exec_driver_sql('BEGIN')
+        with search_index_suspended(conn):
+            for table in reversed(TABLES):
+                conn.execute(table.delete())
+            for name, rows in read_blocks(f):
+                table = tables[name]
+                # Only columns this version knows, others are ignored
+                dates = [c.name for c in table.columns
+                         if isinstance(c.type, DateTime)]
+                known = set(c.name for c in table.columns)
+                for row in rows:
+                    for column in list(row):
+                        if column not in known:
+                            del row[column]
+                    for column in dates:
+                        if row.get(column):
+                            row[column] = datetime.datetime.fromisoformat(
+                                row[column])
+                conn.execute(table.insert(), rows)
+                counts[name] += len(rows)
+        repair_item_counts(conn)
+    return counts
+
+
+def verify_snapshot(path):
+    counts = {}
+    with gzip.open(path, 'rb') as f:
+        for name, rows in read_blocks(f):
+            counts[name] = counts.get(name, 0) + len(rows)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Export, import or verify catalog snapshots')
+    parser.add_argument('command', choices=('export', 'import', 'verify'))
+    parser.add_argument('path', help='snapshot file')
+    parser.add_argument('--encoding', choices=('msgpack', 'json'),
+                        help='block encoding for export, msgpack when it '
+                             'is installed by default')
+    args = parser.parse_args(argv)
+
+    start = time.monotonic()
+    if args.command != 'verify':
+        engine = get_engine()
+        init_database(engine)
+    try:
+        if args.command == 'export':
+            export_snapshot(engine, args.path, args.encoding)
+            counts = None
+        elif args.command == 'import':
+            counts = import_snapshot(engine, args.path)
+        else:
+            counts = verify_snapshot(args.path)
+    except (SnapshotError, zlib.error, EOFError, OSError) as e:
+        print('%s failed: %s' % (args.command, e), file=sys.stderr)
+        raise SystemExit(1)
+
+    if counts is not None:
+        print(', '.join('%s %d' % item for item in sorted(counts.items())))
+    print('%s %s in %.2fs' % (args.command, args.path,
+                              time.monotonic() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+# Jinja fragment caching, template bytecode caching and precompilation
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+
+
+class FragmentCacheExtension(Extension):
+    """Adds a {% cache "name" %}...{% endcache %} tag. The rendered body is
+    stored in environment.fragment_cache under the fragment name plus the
+    tuple returned by environment.fragment_cache_key(), so a fragment is
+    rendered again only when that key changes"""
+
+    tags = {'cache'}
+
+    def __init__(self, environment):
+        Extension.__init__(self, environment)
+        environment.extend(fragment_cache=None, fragment_cache_key=tuple)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        args = [parser.parse_expression()]
+        body = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(self.call_method('_render', args), [], [],
+                               body).set_lineno(lineno)
+
+    def _render(self, name, caller):
+        cache = self.environment.fragment_cache
+        if cache is None:
+            return caller()
+        key = (name,) + tuple(self.environment.fragment_cache_key())
+        return cache.get(key, caller)
+
+
+def init_app(app, fragment_cache, fragment_cache_key, bytecode_dir=None):
+    """Enable fragment caching and a bytecode cache for app's templates.
+    Compiled templates are kept in bytecode_dir, or a per-user directory
+    under the system temp dir when it is None. Must run before the first
+    template is rendered"""
+    app.jinja_options = dict(
+        app.jinja_options,
+        bytecode_cache=FileSystemBytecodeCache(bytecode_dir),
+        extensions=list(app.jinja_options.get('extensions', ())) +
+        [FragmentCacheExtension])
+    app.jinja_env.fragment_cache = fragment_cache
+    app.jinja_env.fragment_cache_key = fragment_cache_key
+
+
+def precompile(app):
+    """Compile every template up front, filling the bytecode cache and the
+    environment's template cache, and return how many were compiled"""
+    env = app.jinja_env
+    names = env.list_templates(filter_func=lambda name: name.endswith(
+        '.html'))
+    for name in names:
+        env.get_template(name)
+    return len(names)
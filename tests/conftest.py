@@ -0,0 +1,69 @@
+# Shared fixtures: one app bound to a temporary database for the whole run,
+# emptied before every test
+import datetime
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                '..')))
+
+
+@pytest.fixture(scope='session')
+def catalog(tmp_path_factory):
+    """The app module, after create_app()"""
+    tmp = tmp_path_factory.mktemp('catalog')
+    import app as catalog
+    catalog.create_app({
+        'SECRET_KEY': 'test',
+        'DATABASE_URL': 'sqlite:///%s' % tmp.joinpath('catalog.db'),
+        'JOB_OUTBOX': str(tmp.joinpath('outbox.db')),
+        'SESSION_STORE': 'memory',
+        'TEMPLATE_CACHE_DIR': str(tmp.joinpath('templates')),
+        'THUMBNAIL_DIR': str(tmp.joinpath('thumbnails')),
+        'RESPONSE_CACHE_VERSION': str(tmp.joinpath('catalog_version')),
+    })
+    return catalog
+
+
+@pytest.fixture
+def db(catalog):
+    """An empty database and empty caches, returns the engine"""
+    from database_setup import Category, Items, User
+    with catalog.engine.begin() as conn:
+        for model in (Items, Category, User):
+            conn.execute(model.__table__.delete())
+    catalog.response_cache.bump_version()
+    for cache in (catalog.category_cache, catalog.fragment_cache,
+                  catalog.user_cache):
+        cache.invalidate()
+    return catalog.engine
+
+
+@pytest.fixture
+def client(catalog, db):
+    return catalog.app.test_client()
+
+
+def add_catalog(engine, categories, items_per_category, picture=None):
+    """Insert a user, categories and their items, returns the item ids"""
+    from database_setup import (Category, Items, User,
+                                repair_item_counts)
+    now = datetime.datetime.now()
+    with engine.begin() as conn:
+        user_id = conn.execute(User.__table__.insert().values(
+            name='user', email='user@example.com',
+            picture='')).inserted_primary_key[0]
+        ids = []
+        for c in range(categories):
+            category_id = conn.execute(Category.__table__.insert().values(
+                name='category %d' % c,
+                user_id=user_id)).inserted_primary_key[0]
+            for i in range(items_per_category):
+                ids.append(conn.execute(Items.__table__.insert().values(
+                    name='item %d.%d' % (c, i), description='d', date=now,
+                    picture=picture, category_id=category_id,
+                    user_id=user_id)).inserted_primary_key[0])
+        repair_item_counts(conn)
+    return ids
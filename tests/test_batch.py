@@ -0,0 +1,106 @@
+import pytest
+
+from conftest import add_catalog
+from database_setup import Category, Items, User
+
+
+def login(client, user_id, email='user@example.com'):
+    with client.session_transaction() as s:
+        s['username'] = 'user'
+        s['user_id'] = user_id
+        s['email'] = email
+
+
+@pytest.fixture
+def user(catalog, client):
+    add_catalog(catalog.engine, 2, 1)
+    with catalog.engine.connect() as conn:
+        user_id = conn.execute(User.__table__.select()).first().id
+    login(client, user_id)
+    return user_id
+
+
+def batch(client, *operations):
+    return client.post('/catalog/batch', json={'operations': operations})
+
+
+def categories(catalog):
+    with catalog.engine.connect() as conn:
+        return dict((row.name, row.item_count) for row in conn.execute(
+            Category.__table__.select()))
+
+
+def test_existing_names_are_row_errors(catalog, client, user):
+    response = batch(
+        client,
+        {'op': 'create', 'type': 'category', 'data': {'name': 'fresh'}},
+        {'op': 'create', 'type': 'category',
+         'data': {'name': 'category 0'}},
+        {'op': 'update', 'type': 'category', 'name': 'category 1',
+         'data': {'name': 'category 0'}})
+    assert response.status_code == 200
+    results = response.get_json()['results']
+    assert [r['status'] for r in results] == ['created', 'error', 'error']
+    assert sorted(categories(catalog)) == ['category 0', 'category 1',
+                                           'fresh']
+
+
+def test_create_then_delete(catalog, client, user):
+    response = batch(
+        client,
+        {'op': 'create', 'type': 'category', 'data': {'name': 'fresh'}},
+        {'op': 'create', 'type': 'item',
+         'data': {'name': 'new', 'category': 'fresh'}},
+        {'op': 'delete', 'type': 'item', 'name': 'new'},
+        {'op': 'delete', 'type': 'category', 'name': 'fresh'})
+    assert response.status_code == 200
+    assert response.get_json()['errors'] == 0
+    assert sorted(categories(catalog)) == ['category 0', 'category 1']
+
+
+def test_move_keeps_item_counts(catalog, client, user):
+    response = batch(
+        client,
+        {'op': 'update', 'type': 'item', 'name': 'item 0.0',
+         'data': {'category': 'category 1'}},
+        {'op': 'create', 'type': 'item',
+         'data': {'name': 'new', 'category': 'category 1'}})
+    assert response.get_json()['errors'] == 0
+    assert categories(catalog) == {'category 0': 0, 'category 1': 3}
+
+
+def test_rows_of_other_users_are_refused(catalog, client, user):
+    with catalog.engine.begin() as conn:
+        other = conn.execute(User.__table__.insert().values(
+            name='other', email='other@example.com',
+            picture='')).inserted_primary_key[0]
+    login(client, other, 'other@example.com')
+    response = batch(
+        client,
+        {'op': 'delete', 'type': 'item', 'name': 'item 0.0'},
+        {'op': 'update', 'type': 'category', 'name': 'category 0',
+         'data': {'name': 'mine'}})
+    assert [r['status'] for r in response.get_json()['results']] == \
+        ['error', 'error']
+    with catalog.engine.connect() as conn:
+        assert conn.execute(Items.__table__.select()).all()
+    assert sorted(categories(catalog)) == ['category 0', 'category 1']
+
+
+@pytest.mark.parametrize('operation', [
+    'create',
+    {'op': 'drop', 'type': 'item', 'id': 1},
+    {'op': 'delete', 'type': 'user', 'id': 1},
+    {'op': 'delete', 'type': 'item'},
+    {'op': 'delete', 'type': 'item', 'id': [1]},
+    {'op': 'delete', 'type': 'item', 'id': True},
+    {'op': 'delete', 'type': 'item', 'name': {'a': 1}},
+    {'op': 'create', 'type': 'category', 'data': {'name': ['a']}},
+    {'op': 'create', 'type': 'item',
+     'data': {'name': 'a', 'category': {'a': 1}}},
+    {'op': 'update', 'type': 'item', 'id': 1, 'data': []},
+])
+def test_malformed_operations(client, user, operation):
+    response = batch(client, operation)
+    assert response.status_code == 400
+    assert 'malformed' in response.get_json()
@@ -0,0 +1,14 @@
+import zlib
+
+from compression import Compressor
+
+
+def test_stream_chunks_decode_as_they_arrive():
+    chunks = ['{"id": %d, "name": "category %d"}\n' % (n, n)
+              for n in range(3)]
+    decoder = zlib.decompressobj(31)
+    compressed = Compressor().compress_stream(iter(chunks), 'gzip')
+    for chunk in chunks:
+        assert decoder.decompress(next(compressed)) == chunk.encode('utf-8')
+    assert decoder.decompress(next(compressed)) == b''
+    assert decoder.eof
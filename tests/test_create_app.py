@@ -0,0 +1,22 @@
+import pytest
+
+
+def test_same_config_returns_the_app(catalog):
+    config = dict(catalog.app.extensions['catalog'])
+    assert catalog.create_app(config) is catalog.app
+
+
+def test_different_config_is_refused(catalog):
+    config = dict(catalog.app.extensions['catalog'],
+                  DATABASE_URL='sqlite:///other.db')
+    with pytest.raises(RuntimeError):
+        catalog.create_app(config)
+    assert catalog.app.extensions['catalog']['DATABASE_URL'] != \
+        'sqlite:///other.db'
+
+
+def test_requests_need_create_app(catalog, client, monkeypatch):
+    monkeypatch.setattr(catalog, 'engine', None)
+    monkeypatch.setattr(catalog.app, 'testing', True)
+    with pytest.raises(RuntimeError):
+        client.get('/catalog/JSON')
@@ -0,0 +1,71 @@
+import datetime
+
+from sqlalchemy.orm import Session
+
+from conftest import add_catalog
+from database_setup import (Category, Items, User, get_engine,
+                            init_database, item_count_mismatches)
+
+
+def counts(engine):
+    with engine.connect() as conn:
+        return item_count_mismatches(conn)
+
+
+def new_catalog():
+    engine = get_engine('sqlite://')
+    init_database(engine)
+    session = Session(engine)
+    a, b = Category(name='A'), Category(name='B')
+    item = Items(name='item', date=datetime.datetime.now(), category=a)
+    session.add_all([a, b, item])
+    session.commit()
+    return engine, session, item, b
+
+
+def user_id(catalog):
+    with catalog.engine.connect() as conn:
+        return conn.execute(User.__table__.select()).first().id
+
+
+def test_move_after_commit():
+    # Every attribute of item is expired, category_id is never loaded
+    engine, session, item, b = new_catalog()
+    item.category = b
+    session.commit()
+    assert counts(engine) == []
+    assert [c.item_count for c in session.query(Category).order_by(
+        Category.id)] == [0, 1]
+
+
+def test_move_loaded_item():
+    engine, session, item, b = new_catalog()
+    session.close()
+    item = session.query(Items).one()
+    item.name = 'renamed'
+    item.category = session.query(Category).filter_by(name='B').one()
+    session.commit()
+    assert counts(engine) == []
+
+
+def test_update_without_move():
+    engine, session, item, b = new_catalog()
+    item.description = 'changed'
+    session.commit()
+    assert counts(engine) == []
+
+
+def test_edit_item_route_moves_item(catalog, client):
+    add_catalog(catalog.engine, 2, 1)
+    with client.session_transaction() as s:
+        s['username'] = 'user'
+        s['user_id'] = user_id(catalog)
+        s['email'] = 'user@example.com'
+    response = client.post('/catalog/category 0/items/item 0.0/edit',
+                           data={'name': 'item 0.0', 'description': 'd',
+                                 'picture': '', 'category': 'category 1'})
+    assert response.status_code == 302
+    assert counts(catalog.engine) == []
+    with catalog.engine.connect() as conn:
+        assert conn.execute(Category.__table__.select().order_by(
+            Category.id)).all()[1].item_count == 2
@@ -0,0 +1,85 @@
+import sqlite3
+import threading
+import time
+
+from jobs import JobQueue
+
+
+def running_job(path, lease_until):
+    """Put a job claimed by another process in the outbox at path"""
+    JobQueue(path, workers=1).stop()
+    now = time.time()
+    with sqlite3.connect(path) as conn:
+        conn.execute("INSERT INTO outbox (name, payload, status, created_at, "
+                     "run_at, claimed_by, lease_until) VALUES "
+                     "('ping', '{}', 'running', ?, ?, 'other:1:1', ?)",
+                     (now, now, lease_until))
+
+
+def start(path, lease=60.0):
+    ran = threading.Event()
+    jobs = JobQueue(path, workers=1, lease=lease)
+    jobs.handler('ping')(ran.set)
+    return jobs, ran
+
+
+def test_live_lease_is_not_run_again(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    running_job(path, time.time() + 60)
+    jobs, ran = start(path)
+    try:
+        assert not ran.wait(1.5)
+        assert jobs.stats['running'] == 1
+    finally:
+        jobs.stop()
+
+
+def test_expired_lease_is_run_again(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    running_job(path, time.time() - 1)
+    jobs, ran = start(path)
+    try:
+        assert ran.wait(5)
+    finally:
+        jobs.stop()
+
+
+def test_running_jobs_renew_their_lease(tmp_path):
+    path = str(tmp_path / 'outbox.db')
+    release = threading.Event()
+    jobs = JobQueue(path, workers=1, lease=0.6)
+    jobs.handler('slow')(lambda: release.wait(5))
+    try:
+        jobs.enqueue('slow')
+        time.sleep(2)
+        with sqlite3.connect(path) as conn:
+            owner, lease_until = conn.execute(
+                'SELECT claimed_by, lease_until FROM outbox').fetchone()
+        assert owner == jobs.owner
+        assert lease_until > time.time()
+    finally:
+        release.set()
+        jobs.stop()
+
+
+def test_dispatcher_survives_errors(tmp_path, monkeypatch):
+    path = str(tmp_path / 'outbox.db')
+    jobs, ran = start(path)
+    connect = jobs._connect
+    failures = [2]
+
+    def flaky():
+        if threading.current_thread().name == 'jobs-dispatcher' and \
+                failures[0]:
+            failures[0] -= 1
+            raise sqlite3.OperationalError('database is locked')
+        return connect()
+
+    monkeypatch.setattr(jobs, '_connect', flaky)
+    try:
+        time.sleep(0.1)
+        jobs.enqueue('ping')
+        assert ran.wait(5)
+        assert failures == [0]
+    finally:
+        jobs.stop()
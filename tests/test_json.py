@@ -0,0 +1,40 @@
+import json
+
+from sqlalchemy import event
+
+from conftest import add_catalog
+
+
+class StatementCounter(object):
+    def __init__(self, engine):
+        self.engine = engine
+        self.statements = []
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self.count)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.engine, 'before_cursor_execute', self.count)
+
+    def count(self, conn, cursor, statement, *args):
+        self.statements.append(statement)
+
+
+def test_catalog_json_is_one_select(catalog, client):
+    add_catalog(catalog.engine, 20, 5)
+    with StatementCounter(catalog.engine) as counter:
+        response = client.get('/catalog/JSON')
+    assert response.status_code == 200
+    categories = json.loads(response.data)['Category']
+    assert len(categories) == 20
+    assert all(len(c['Items']) == 5 for c in categories)
+    assert len(counter.statements) == 1
+    assert counter.statements[0].lstrip().upper().startswith('SELECT')
+
+
+def test_catalog_stream_is_one_select(catalog, client):
+    add_catalog(catalog.engine, 50, 2)
+    with StatementCounter(catalog.engine) as counter:
+        client.get('/catalog/JSON/stream')
+    assert len(counter.statements) == 1
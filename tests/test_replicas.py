@@ -0,0 +1,39 @@
+import time
+
+from database_setup import get_engine, init_database
+from replicas import Router
+
+
+def test_one_process_writes_the_heartbeat(tmp_path):
+    url = 'sqlite:///%s' % (tmp_path / 'catalog.db')
+    primary = get_engine(url)
+    init_database(primary)
+    first = Router.from_urls(primary, ['readonly'])
+    second = Router.from_urls(get_engine(url), ['readonly'])
+
+    assert first.lock.acquire()
+    assert not second.lock.acquire()
+    assert first.stats['heartbeat_writer']
+    assert not second.stats['heartbeat_writer']
+
+    # The writer exits and the other process takes over
+    first.lock._file.close()
+    assert second.lock.acquire()
+
+
+def test_replicas_wait_for_commits_of_other_workers(tmp_path):
+    url = 'sqlite:///%s' % (tmp_path / 'catalog.db')
+    primary = get_engine(url)
+    init_database(primary)
+    commits = [0.0]
+    router = Router.from_urls(primary, ['readonly'], heartbeat_interval=0,
+                              last_commit=lambda: commits[0])
+    router.beat()
+    replica, = router.replicas
+    assert router.read_engine() is replica
+
+    # Another worker committed after the replica's last heartbeat
+    commits[0] = time.time()
+    assert router.read_engine() is primary
+    router.beat()
+    assert router.read_engine() is replica
@@ -0,0 +1,45 @@
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import MemoryBackend
+from conftest import add_catalog
+
+
+def test_version_is_shared_between_backends(tmp_path):
+    path = str(tmp_path.joinpath('version'))
+    first = MemoryBackend(version_file=path)
+    second = MemoryBackend(version_file=path)
+    first.bump_version()
+    assert second.get_version() == first.get_version() == 1
+
+
+def test_concurrent_bumps_are_counted(tmp_path):
+    path = str(tmp_path.joinpath('version'))
+    backends = [MemoryBackend(version_file=path) for n in range(2)]
+    with ThreadPoolExecutor(8) as pool:
+        list(pool.map(lambda n: backends[n % 2].bump_version(), range(200)))
+    assert backends[0].get_version() == 200
+
+
+def test_entries_expire():
+    backend = MemoryBackend(ttl=0)
+    backend.store('0:/catalog/JSON', ('etag', 'application/json', b'{}'))
+    assert backend.load('0:/catalog/JSON') is None
+
+
+def test_write_in_another_worker_invalidates(catalog, client):
+    add_catalog(catalog.engine, 1, 0)
+    assert len(json.loads(client.get('/catalog/categories/JSON').data)
+               ['categories']) == 1
+    # Written behind this worker's back, its cache is still valid
+    from database_setup import Category
+    with catalog.engine.begin() as conn:
+        conn.execute(Category.__table__.insert().values(name='new'))
+    assert len(json.loads(client.get('/catalog/categories/JSON').data)
+               ['categories']) == 1
+    # Another worker bumps the shared version after its write
+    other = MemoryBackend(
+        version_file=catalog.response_cache.backend.version_file.path)
+    other.bump_version()
+    assert len(json.loads(client.get('/catalog/categories/JSON').data)
+               ['categories']) == 2
@@ -0,0 +1,41 @@
+from types import SimpleNamespace
+
+import oauth
+
+
+def session_id(client, catalog):
+    cookie = client.get_cookie(catalog.app.config['SESSION_COOKIE_NAME'])
+    return cookie and cookie.value
+
+
+def fake_google(monkeypatch):
+    credentials = SimpleNamespace(access_token='token',
+                                  id_token={'sub': 'google-id'})
+    monkeypatch.setattr(oauth, 'client_id', lambda: 'client')
+    monkeypatch.setattr(oauth, 'exchange_code', lambda code: credentials)
+    monkeypatch.setattr(oauth, 'get_token_info', lambda token: {
+        'user_id': 'google-id', 'issued_to': 'client'})
+    monkeypatch.setattr(oauth, 'get_user_info', lambda token: {
+        'name': 'user', 'picture': '', 'email': 'user@example.com'})
+    monkeypatch.setattr(oauth, 'revoke_token', lambda token: True)
+
+
+def test_login_and_logout_change_the_session_id(catalog, client,
+                                                monkeypatch):
+    fake_google(monkeypatch)
+    store = catalog.app.session_interface.store
+    client.get('/login')
+    anonymous = session_id(client, catalog)
+    with client.session_transaction() as s:
+        state = s['state']
+
+    assert client.post('/gconnect?state=' + state,
+                       data=b'code').status_code == 200
+    logged_in = session_id(client, catalog)
+    assert logged_in != anonymous
+    assert store.load(anonymous) is None
+    assert store.load(logged_in) is not None
+
+    client.get('/gdisconnect')
+    assert session_id(client, catalog) not in (None, logged_in)
+    assert store.load(logged_in) is None
@@ -0,0 +1,124 @@
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import thumbnails
+from conftest import add_catalog
+from thumbnails import ThumbnailError, Thumbnailer
+
+# A 1x1 PNG
+PNG = bytes.fromhex(
+    '89504e470d0a1a0a0000000d4948445200000001000000010802000000907753'
+    'de0000000c4944415408d763f8ffff3f0005fe02fe0ddbb4a60000000049454e44'
+    'ae426082')
+
+
+class PictureHost(object):
+    """Serves PNG at /picture.png after delay seconds, redirects
+    /redirect to the location set on it and counts requests"""
+
+    def __init__(self, delay=0.0):
+        self.requests = []
+        self.location = None
+        host = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                host.requests.append(self.path)
+                time.sleep(delay)
+                if self.path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', host.location)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/png')
+                self.send_header('Content-Length', str(len(PNG)))
+                self.end_headers()
+                self.wfile.write(PNG)
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.port = self.server.server_address[1]
+        self.url = 'http://127.0.0.1:%d' % self.port
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+@pytest.fixture
+def host():
+    host = PictureHost(delay=0.2)
+    yield host
+    host.close()
+
+
+@pytest.fixture
+def thumbnailer(tmp_path):
+    return Thumbnailer(str(tmp_path / 'thumbnails'), workers=2)
+
+
+def test_concurrent_requests_fetch_once(catalog, db, client, host,
+                                        monkeypatch):
+    monkeypatch.setattr(catalog.thumbnailer, 'allow_private', True)
+    item_id, = add_catalog(db, 1, 1, picture=host.url + '/picture.png')
+    url = '/media/thumb/%d?size=160' % item_id
+    with ThreadPoolExecutor(8) as pool:
+        responses = list(pool.map(lambda n: client.get(url), range(8)))
+    assert [r.status_code for r in responses] == [200] * 8
+    assert host.requests == ['/picture.png']
+
+    etag = responses[0].headers['ETag']
+    assert client.get(url, headers={'If-None-Match': etag}).status_code \
+        == 304
+
+
+def test_private_address_is_refused(catalog, db, client, host):
+    item_id, = add_catalog(db, 1, 1, picture=host.url + '/picture.png')
+    response = client.get('/media/thumb/%d' % item_id)
+    assert response.status_code == 502
+    assert response.get_data(as_text=True) == 'Picture unavailable'
+    assert host.requests == []
+
+
+def test_redirects_are_checked(thumbnailer, host, monkeypatch):
+    # 127.0.0.1 counts as public here, the redirect target does not
+    monkeypatch.setattr(thumbnails, 'public_address',
+                        lambda address: address == '127.0.0.1')
+    host.location = 'http://127.0.0.2:%d/picture.png' % host.port
+    with pytest.raises(ThumbnailError, match='not a public address'):
+        thumbnailer.fetch(host.url + '/redirect')
+    assert host.requests == ['/redirect']
+
+    host.location = '/picture.png'
+    assert thumbnailer.fetch(host.url + '/redirect') == PNG
+
+
+def test_connected_address_is_checked(thumbnailer, host, monkeypatch):
+    # The name resolves to a public address when it is checked, and to
+    # 127.0.0.1 when it is connected to
+    resolve = socket.getaddrinfo
+    resolved = []
+
+    def getaddrinfo(name, port, *args, **kwargs):
+        if name == 'pictures.test':
+            resolved.append(name)
+            name = '198.51.100.1' if len(resolved) == 1 else '127.0.0.1'
+        return resolve(name, port, *args, **kwargs)
+
+    monkeypatch.setattr(socket, 'getaddrinfo', getaddrinfo)
+    monkeypatch.setattr(thumbnails, 'public_address',
+                        lambda address: address == '198.51.100.1')
+    with pytest.raises(ThumbnailError, match='not a public address'):
+        thumbnailer.fetch('http://pictures.test:%d/picture.png' % host.port)
+    assert len(resolved) == 2
+    assert host.requests == []
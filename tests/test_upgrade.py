@@ -0,0 +1,33 @@
+import logging
+
+from sqlalchemy import inspect, text
+
+from database_setup import get_engine, init_database
+
+
+def old_database(path):
+    """A database created before the indexes existed, with a duplicate
+    email"""
+    engine = get_engine('sqlite:///%s' % path)
+    with engine.begin() as conn:
+        conn.execute(text('CREATE TABLE user (id INTEGER PRIMARY KEY, '
+                          'name VARCHAR(250) NOT NULL, email VARCHAR(250) '
+                          'NOT NULL, picture VARCHAR(250))'))
+        conn.execute(text('CREATE TABLE category (id INTEGER PRIMARY KEY, '
+                          'name VARCHAR(50) NOT NULL, user_id INTEGER)'))
+        conn.execute(text("INSERT INTO user (name, email) VALUES "
+                          "('a', 'same@example.com'), "
+                          "('b', 'same@example.com')"))
+    return engine
+
+
+def test_upgrade_skips_unique_index_over_duplicates(tmp_path, caplog):
+    engine = old_database(tmp_path.joinpath('old.db'))
+    with caplog.at_level(logging.WARNING):
+        init_database(engine)
+    assert 'ix_user_email' in caplog.text
+    indexes = dict((i['name'], i) for i in inspect(engine).get_indexes('user'))
+    assert 'ix_user_email' not in indexes
+    categories = inspect(engine).get_indexes('category')
+    assert any(i['name'] == 'ix_category_name' and i['unique']
+               for i in categories)
@@ -0,0 +1,338 @@
+# Thumbnails of remote item pictures, fetched once and kept on disk
+#
+# Pictures are downloaded by a small pool of worker threads. Concurrent
+# requests for the same thumbnail wait for one download instead of each
+# starting their own. Originals and resized copies are stored in a
+# directory bounded to `max_bytes`, evicting the least recently used files
+# first. Resizing needs Pillow. Without it the original image is served.
+#
+# Picture URLs come from users, so only public addresses are fetched. The
+# host of every URL, including each redirect, is resolved and refused if
+# any of its addresses is private, loopback, link-local or reserved, and
+# the address of every new connection is checked again, before anything
+# is sent, in case the name resolved differently the second time.
+import hashlib
+import io
+import ipaddress
+import os
+import socket
+import tempfile
+import threading
+from collections import OrderedDict, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urljoin, urlsplit
+
+from cache import TTLCache
+
+# Seconds to wait for the remote host (connect, read)
+TIMEOUT = (3.05, 10)
+# Largest picture that is downloaded
+MAX_SOURCE_BYTES = 10 * 1024 * 1024
+# Seconds before a failed picture is tried again
+FAILURE_TTL = 60
+# Redirects followed per picture
+MAX_REDIRECTS = 3
+
+# Raster formats by their first bytes. Anything else, SVG in particular,
+# is never served from our origin
+SIGNATURES = [(b'\x89PNG\r\n\x1a\n', 'image/png'),
+              (b'\xff\xd8\xff', 'image/jpeg'),
+              (b'GIF87a', 'image/gif'),
+              (b'GIF89a', 'image/gif')]
+
+Thumbnail = namedtuple('Thumbnail', 'path mimetype etag modified')
+
+
+class ThumbnailError(Exception):
+    """The picture could not be fetched or is not a supported image"""
+
+
+def default_dir():
+    return os.path.join(tempfile.gettempdir(),
+                        'catalog-thumbnails-%d' % os.getuid())
+
+
+def sniff_type(data):
+    """The mimetype of a PNG, JPEG, GIF or WebP image, otherwise None"""
+    for signature, mimetype in SIGNATURES:
+        if data.startswith(signature):
+            return mimetype
+    if data[:4] == b'RIFF' and data[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def public_address(address):
+    """Whether an IP address string is routable on the internet"""
+    address = ipaddress.ip_address(address.split('%', 1)[0])
+    if address.version == 6 and address.ipv4_mapped:
+        address = address.ipv4_mapped
+    return not (address.is_private or address.is_loopback or
+                address.is_link_local or address.is_reserved or
+                address.is_multicast or address.is_unspecified)
+
+
+def checked_adapter(thumbnailer):
+    """A requests adapter that drops new connections to addresses that
+    aren't public, before anything is sent, unless the thumbnailer allows
+    private ones"""
+    from requests.adapters import HTTPAdapter
+    from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+
+    def checked(pool):
+        base = pool.ConnectionCls
+
+        class Connection(base):
+            def _new_conn(self):
+                sock = base._new_conn(self)
+                address = sock.getpeername()[0]
+                if not thumbnailer.allow_private and \
+                        not public_address(address):
+                    sock.close()
+                    raise ThumbnailError('%s connected to %s, not a public '
+                                         'address' % (self.host, address))
+                return sock
+
+        return type(pool.__name__, (pool,), {'ConnectionCls': Connection})
+
+    class Adapter(HTTPAdapter):
+        def init_poolmanager(self, *args, **kwargs):
+            HTTPAdapter.init_poolmanager(self, *args, **kwargs)
+            self.poolmanager.pool_classes_by_scheme = {
+                'http': checked(HTTPConnectionPool),
+                'https': checked(HTTPSConnectionPool)}
+
+    return Adapter()
+
+
+def resize(data, size):
+    """Scale an image down to fit in size x size pixels"""
+    try:
+        from PIL import Image
+    except ImportError:
+        return data
+    try:
+        image = Image.open(io.BytesIO(data))
+        if image.width <= size and image.height <= size:
+            return data
+        image.thumbnail((size, size))
+        output = io.BytesIO()
+        if image.mode in ('RGBA', 'LA') or 'transparency' in image.info:
+            image.save(output, 'PNG', optimize=True)
+        else:
+            image.convert('RGB').save(output, 'JPEG', quality=85,
+                                      optimize=True)
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ThumbnailError('cannot resize: %s' % e)
+    return output.getvalue()
+
+
+class DiskCache(object):
+    """A directory of files bounded to max_bytes. Every process keeps its
+    own recency order, which starts from the access times on disk"""
+
+    def __init__(self, path, max_bytes):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+        entries = []
+        for name in os.listdir(path):
+            if name.endswith('.tmp'):
+                continue
+            try:
+                stat = os.stat(os.path.join(path, name))
+            except OSError:
+                continue
+            entries.append((stat.st_atime, name, stat.st_size))
+        for atime, name, size in sorted(entries):
+            self._files[name] = size
+            self.size += size
+
+    def file(self, name):
+        return os.path.join(self.path, name)
+
+    def get(self, name):
+        """The path of a cached file, or None"""
+        with self._lock:
+            if name in self._files and os.path.exists(self.file(name)):
+                self._files.move_to_end(name)
+                self.hits += 1
+                return self.file(name)
+            self._files.pop(name, None)
+            self.misses += 1
+            return None
+
+    def read(self, name):
+        path = self.get(name)
+        if path is None:
+            return None
+        with open(path, 'rb') as f:
+            return f.read()
+
+    def put(self, name, data):
+        path = self.file(name)
+        tmp = '%s.%d.%d.tmp' % (path, os.getpid(), threading.get_ident())
+        with open(tmp, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+        with self._lock:
+            self.size += len(data) - self._files.pop(name, 0)
+            self._files[name] = len(data)
+            while self.size > self.max_bytes and len(self._files) > 1:
+                old, size = self._files.popitem(last=False)
+                self.size -= size
+                self.evictions += 1
+                try:
+                    os.remove(self.file(old))
+                except OSError:
+                    pass
+        return path
+
+    @property
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'files': len(self._files),
+                    'bytes': self.size, 'max_bytes': self.max_bytes}
+
+
+class Thumbnailer(object):
+    """Builds and caches thumbnails of picture URLs. allow_private lets
+    it fetch from private addresses, for local development and tests"""
+
+    def __init__(self, path=None, max_bytes=256 * 1024 * 1024, workers=4,
+                 allow_private=False):
+        self.cache = DiskCache(path or default_dir(), max_bytes)
+        self.workers = workers
+        self.allow_private = allow_private
+        self.fetches = 0
+        self.collapsed = 0
+        self.errors = 0
+        self.failures = TTLCache(ttl=FAILURE_TTL, maxsize=1024)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._pool = None
+        self._http_session = None
+
+    def get(self, url, size):
+        """Return the Thumbnail of url scaled to size, building it in the
+        worker pool on a miss. Raises ThumbnailError"""
+        name = '%s-%d' % (hashlib.sha1(url.encode('utf-8')).hexdigest(),
+                          size)
+        path = self.cache.get(name)
+        if path is None:
+            found, error = self.failures.lookup(name)
+            if found:
+                raise ThumbnailError(error)
+            with self._lock:
+                future = self._pending.get(name)
+                if future is None:
+                    if self._pool is None:
+                        self._pool = ThreadPoolExecutor(
+                            self.workers, thread_name_prefix='thumbnails')
+                    future = self._pool.submit(self.build, name, url, size)
+                    self._pending[name] = future
+                    future.add_done_callback(
+                        lambda f: self._pending.pop(name, None))
+                else:
+                    self.collapsed += 1
+            path = future.result()
+        with open(path, 'rb') as f:
+            mimetype = sniff_type(f.read(12))
+        return Thumbnail(path, mimetype, name,
+                         int(os.path.getmtime(path)))
+
+    def build(self, name, url, size):
+        """Resize the original, fetching it if it isn't cached, and store
+        the thumbnail. Failures are remembered for FAILURE_TTL seconds"""
+        try:
+            original = '%s-original' % name.rsplit('-', 1)[0]
+            data = self.cache.read(original)
+            if data is None:
+                data = self.fetch(url)
+                self.cache.put(original, data)
+            return self.cache.put(name, resize(data, size))
+        except ThumbnailError as e:
+            self.errors += 1
+            self.failures.set(name, str(e))
+            raise
+
+    def http_session(self):
+        with self._lock:
+            if self._http_session is None:
+                import requests
+                self._http_session = requests.Session()
+                # A proxy would hide the address that is connected to
+                self._http_session.trust_env = False
+                adapter = checked_adapter(self)
+                self._http_session.mount('http://', adapter)
+                self._http_session.mount('https://', adapter)
+            return self._http_session
+
+    def check_url(self, url):
+        """Raise ThumbnailError unless url is http(s) and its host only
+        resolves to public addresses"""
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise ThumbnailError('not an http(s) URL')
+        if self.allow_private:
+            return
+        try:
+            port = parts.port or (443 if parts.scheme == 'https' else 80)
+            addresses = socket.getaddrinfo(parts.hostname, port,
+                                           proto=socket.IPPROTO_TCP)
+        except (OSError, ValueError, UnicodeError) as e:
+            raise ThumbnailError('cannot resolve %s: %s'
+                                 % (parts.hostname, e))
+        for family, kind, proto, name, address in addresses:
+            if not public_address(address[0]):
+                raise ThumbnailError('%s resolves to %s, not a public '
+                                     'address' % (parts.hostname,
+                                                  address[0]))
+
+    def fetch(self, url):
+        import requests
+        self.fetches += 1
+        try:
+            for redirect in range(MAX_REDIRECTS + 1):
+                self.check_url(url)
+                data, location = self.download(url)
+                if location is None:
+                    break
+                url = urljoin(url, location)
+            else:
+                raise ThumbnailError('too many redirects')
+        except requests.RequestException as e:
+            raise ThumbnailError(str(e))
+        if sniff_type(data) is None:
+            raise ThumbnailError('%s is not a supported image' % url)
+        return data
+
+    def download(self, url):
+        """The body of url, or None and the location it redirects to"""
+        with self.http_session().get(url, timeout=TIMEOUT, stream=True,
+                                     allow_redirects=False) as response:
+            if response.is_redirect:
+                return None, response.headers['Location']
+            if response.status_code != 200:
+                raise ThumbnailError('%s returned %d'
+                                     % (url, response.status_code))
+            data = bytearray()
+            for chunk in response.iter_content(64 * 1024):
+                data += chunk
+                if len(data) > MAX_SOURCE_BYTES:
+                    raise ThumbnailError('%s is too large' % url)
+            return bytes(data), None
+
+    @property
+    def stats(self):
+        stats = self.cache.stats
+        stats.update(fetches=self.fetches, collapsed=self.collapsed,
+                     errors=self.errors, pending=len(self._pending))
+        return stats